@@ -0,0 +1,1140 @@
+import sys
+import os
+import json
+import random
+import shutil
+import asyncio
+import tempfile
+import argparse
+import resource
+import tracemalloc
+import subprocess
+import urllib.request
+from time import (
+    time,
+    sleep,
+    perf_counter
+)
+from timeit import Timer
+from itertools import count
+from contextlib import contextmanager
+from dataclasses import (
+    fields,
+    replace
+)
+
+import numpy as np
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from aiogram.types import Update
+from aiogram.dispatcher.webhook import (
+    WebhookRequestHandler,
+    BOT_DISPATCHER_KEY
+)
+
+from main import (
+    DynamoStore,
+    SqliteStore,
+    DYNAMO_ENDPOINT,
+    Moder,
+    load_local_model,
+    Pipeline,
+    WebhookFilter,
+    LOG_HANDLER,
+    start_log_listener,
+    stop_log_listener,
+
+    Voting,
+    UserStats,
+    dynamo_ser_obj,
+    dynamo_deser_item,
+)
+from train import load_corpus
+from test import (
+    Bot,
+    Dispatcher,
+    CHAT_ID,
+
+    FakeBot,
+    FakeDB,
+    FakeDynamoClient,
+    FakeModer,
+    FakeBotContext,
+    INIT_VOTING,
+
+    message_json,
+    reply_message_json,
+    poll_answer_json,
+)
+
+
+# Offline benchmarks, no network
+# python bench.py moder corpus.jsonl moder.npz
+# python bench.py codec
+# python bench.py updates --output bench.jsonl
+# python bench.py compare bench.jsonl
+# python bench.py webhook
+# python bench.py loadgen --rate 50,100,200,400
+# python bench.py startup --output startup.jsonl
+# python bench.py db
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def format_timings(timings):
+    p50, p95, p99 = np.percentile(timings, [50, 95, 99]) * 1e6
+    return f'p50={p50:.1f}us, p95={p95:.1f}us, p99={p99:.1f}us'
+
+
+######
+#
+#   MODER
+#
+#####
+
+
+def bench_moder(args):
+    texts, labels = load_corpus(args.corpus)
+
+    moder = Moder()
+    moder.local_model = load_local_model(args.model)
+
+    preds, timings = [], []
+    for text in texts:
+        start = perf_counter()
+        pred = moder.local_predict(text)
+        timings.append(perf_counter() - start)
+        preds.append(pred)
+
+    local = [
+        (pred, label)
+        for pred, label in zip(preds, labels)
+        if pred
+    ]
+    errors = sum(pred.is_spam != bool(label) for pred, label in local)
+    remote = len(texts) - len(local)
+
+    log(f'texts={len(texts)}, local={len(local)}, remote={remote}')
+    log(f'remote calls reduction={len(local) / len(texts):.1%}')
+    log(f'local errors={errors}, error rate={errors / max(len(local), 1):.2%}')
+    log(f'local latency {format_timings(timings)}')
+
+    # Remote call is measured in seconds, BERT + network
+    before = len(texts) * args.remote_latency
+    after = sum(timings) + remote * args.remote_latency
+    log(
+        f'mean latency, remote only={before / len(texts) * 1000:.1f}ms, '
+        f'cascade={after / len(texts) * 1000:.1f}ms'
+    )
+
+
+######
+#
+#   CODEC
+#
+#####
+
+
+# DynamoDB de/ser before per-dataclass codecs, for reference
+
+
+def legacy_deser_value(value, annot):
+    if annot == int:
+        return int(value)
+    elif annot == str:
+        return value
+    elif annot == bool:
+        return value
+    elif annot == [int]:
+        return [int(_) for _ in value]
+
+
+def legacy_ser_value(value, annot):
+    if annot == int:
+        return str(value)
+    elif annot == str:
+        return value
+    elif annot == bool:
+        return value
+    elif annot == [int]:
+        return [str(_) for _ in value]
+
+
+def legacy_obj_annots(obj):
+    for field in fields(obj):
+        yield field.name, field.type
+
+
+def legacy_annot_key_type(annot):
+    if annot == int:
+        return 'N'
+    elif annot == str:
+        return 'S'
+    elif annot == bool:
+        return 'BOOL'
+    elif annot == [int]:
+        return 'NS'
+
+
+def legacy_deser_item(item, cls):
+    kwargs = {}
+    for key_name, annot in legacy_obj_annots(cls):
+        if key_name not in item:
+            if annot == [int]:
+                kwargs[key_name] = []
+            continue
+
+        key_type = legacy_annot_key_type(annot)
+        value = item[key_name][key_type]
+        value = legacy_deser_value(value, annot)
+        kwargs[key_name] = value
+    return cls(**kwargs)
+
+
+def legacy_ser_obj(obj):
+    item = {}
+    for key_name, annot in legacy_obj_annots(obj):
+        value = getattr(obj, key_name)
+        if annot == [int] and not value:
+            continue
+
+        value = legacy_ser_value(value, annot)
+        key_type = legacy_annot_key_type(annot)
+        item[key_name] = {key_type: value}
+    return item
+
+
+def timeit_us(call, number):
+    # Best of 5 repeats, per call
+    timer = Timer(call)
+    return min(timer.repeat(5, number)) / number * 1e6
+
+
+def bench_codec(args):
+    objs = [
+        Voting(
+            poll_id='123', chat_id=-100,
+            candidate_message_id=1, start_message_id=2, poll_message_id=3,
+            candidate_user_id=4, starter_user_id=5,
+            ban_user_ids=list(range(7)), no_ban_user_ids=list(range(3)),
+            min_votes=10, deadline=1700000000, expires_at=1700600000
+        ),
+        UserStats(chat_id=-100, user_id=1, message_count=5),
+    ]
+    for obj in objs:
+        cls = type(obj)
+        item = dynamo_ser_obj(obj)
+        assert item == legacy_ser_obj(obj)
+        assert dynamo_deser_item(item, cls) == legacy_deser_item(item, cls)
+
+        for name, legacy, codec in [
+                (
+                    'ser',
+                    lambda: legacy_ser_obj(obj),
+                    lambda: dynamo_ser_obj(obj)
+                ),
+                (
+                    'deser',
+                    lambda: legacy_deser_item(item, cls),
+                    lambda: dynamo_deser_item(item, cls)
+                ),
+        ]:
+            before = timeit_us(legacy, args.number)
+            after = timeit_us(codec, args.number)
+            log(
+                f'{cls.__name__} {name}, legacy={before:.2f}us, '
+                f'codec={after:.2f}us, speedup={before / after:.1f}x'
+            )
+
+
+######
+#
+#   DB
+#
+#####
+
+
+# Per-op latency of stores, caches of DB not involved. DynamoDB is
+# real with DYNAMO_ENDPOINT and credentials in env. Otherwise client
+# is in-memory fake from test.py: it measures codec and client
+# overhead only, no network, not comparable to SQLite disk writes
+
+
+async def dynamo_store():
+    store = DynamoStore()
+    if DYNAMO_ENDPOINT:
+        await store.connect()
+        return store, 'dynamo'
+
+    log('no DYNAMO_ENDPOINT, dynamo is fake, overhead only')
+    store.client = FakeDynamoClient()
+    return store, 'dynamo fake'
+
+
+def store_ops(store, index):
+    # Unique keys
+    voting = replace(INIT_VOTING, poll_id=f'bench-{index}')
+    key = (-1, -index - 1)
+    return [
+        ('put_voting', lambda: store.put_voting(voting)),
+        ('get_voting', lambda: store.get_voting(voting.poll_id)),
+        ('delete_voting', lambda: store.delete_voting(voting.poll_id)),
+        ('put_user_stats', lambda: store.put_user_stats(UserStats(*key, 1))),
+        ('get_user_stats', lambda: store.get_user_stats(key)),
+        ('delete_user_stats', lambda: store.delete_user_stats(key)),
+        ('add_user_stats', lambda: store.add_user_stats(key, 1)),
+    ]
+
+
+async def bench_store(store, number):
+    timings = {}
+    for index in range(number):
+        for name, call in store_ops(store, index):
+            start = perf_counter()
+            await call()
+            timings.setdefault(name, []).append(perf_counter() - start)
+    return timings
+
+
+async def bench_db_async(args):
+    directory = tempfile.mkdtemp()
+    sqlite_store = SqliteStore(os.path.join(directory, 'bench.db'))
+    await sqlite_store.connect()
+
+    dynamo, name = await dynamo_store()
+    for name, store in [('sqlite', sqlite_store), (name, dynamo)]:
+        timings = await bench_store(store, args.number)
+        for op, values in timings.items():
+            log(f'{name}, {op}, {format_timings(values)}')
+        if store is sqlite_store or DYNAMO_ENDPOINT:
+            await store.close()
+
+    shutil.rmtree(directory)
+
+
+def bench_db(args):
+    asyncio.run(bench_db_async(args))
+
+
+######
+#
+#   UPDATES
+#
+#####
+
+
+# Push update mix through dispatcher.process_update with fakes from
+# test.py, backends sleep for given latency
+
+
+class LatencyFakeBot(FakeBot):
+    latency = 0
+
+    async def request(self, method, data):
+        # No trace, grows with every update
+        await asyncio.sleep(self.latency)
+        return {}
+
+
+class LatencyFakeDB(FakeDB):
+    latency = 0
+
+    async def sleep(self):
+        await asyncio.sleep(self.latency)
+
+    async def increment_user_stats(self, key):
+        await self.sleep()
+        return await FakeDB.increment_user_stats(self, key)
+
+    async def put_voting(self, obj):
+        await self.sleep()
+        await FakeDB.put_voting(self, obj)
+
+    async def record_vote(self, poll_id, user_id, option):
+        await self.sleep()
+        return await FakeDB.record_vote(self, poll_id, user_id, option)
+
+    async def close_voting(self, poll_id):
+        await self.sleep()
+        return await FakeDB.close_voting(self, poll_id)
+
+    # No DynamoDB client, flush loop in serve
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class LatencyFakeModer(FakeModer):
+    latency = 0
+
+    async def predict(self, text):
+        await asyncio.sleep(self.latency)
+        return self.pred
+
+
+def bench_context(args):
+    context = FakeBotContext()
+    context.bot = LatencyFakeBot('1:token')
+    context.dispatcher = Dispatcher(context.bot)
+    context.db = LatencyFakeDB()
+    context.moder = LatencyFakeModer()
+
+    context.bot.latency = args.bot_latency
+    context.db.latency = args.db_latency
+    context.moder.latency = args.moder_latency
+
+    context.setup_handlers()
+    context.setup_middlewares()
+    Bot.set_current(context.bot)
+    Dispatcher.set_current(context.dispatcher)
+    return context
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, weight = part.split('=')
+        mix[kind] = float(weight)
+    return mix
+
+
+def update_data(kind, generator, users):
+    user_id = generator.randrange(users) + 1
+
+    if kind == 'message':
+        # Random words, pred cache hits like in a real chat
+        text = ' '.join(
+            generator.choice(['привет', 'bert', 'natasha', 'токен', 'спам'])
+            for _ in range(5)
+        )
+        data = json.loads(message_json(CHAT_ID, text))
+        data['message']['from']['id'] = user_id
+    elif kind == 'voteban':
+        data = json.loads(reply_message_json('/voteban'))
+        data['message']['from']['id'] = user_id
+    elif kind == 'poll_answer':
+        data = json.loads(poll_answer_json(generator.randrange(2)))
+        data['poll_answer']['user']['id'] = user_id
+    elif kind == 'foreign':
+        data = json.loads(message_json(CHAT_ID - 1, 'привет'))
+    elif kind == 'edit':
+        data = json.loads(message_json(CHAT_ID, 'привет'))
+        data['edited_message'] = data.pop('message')
+    elif kind == 'service':
+        data = json.loads(message_json(CHAT_ID, 'привет'))
+        data['message'].pop('text')
+        data['message']['new_chat_members'] = [data['message']['from']]
+    return data
+
+
+def generate_updates(args):
+    mix = parse_mix(args.mix)
+    kinds, weights = zip(*mix.items())
+    generator = random.Random(args.seed)
+    return [
+        json.dumps(update_data(kind, generator, args.users))
+        for kind in generator.choices(kinds, weights, k=args.updates)
+    ]
+
+
+async def process_json(context, body):
+    # Same as webhook: parse body, build Update, dispatch
+    update = Update(**json.loads(body))
+    await context.dispatcher.process_update(update)
+
+
+async def run_updates(context, updates, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def process(body):
+        async with semaphore:
+            start = perf_counter()
+            await process_json(context, body)
+            timings.append(perf_counter() - start)
+
+    start = perf_counter()
+    await asyncio.gather(*(process(_) for _ in updates))
+    return perf_counter() - start, timings
+
+
+async def measure_allocs(context, updates):
+    # Peak traced memory while processing single update
+    peaks = []
+    tracemalloc.start()
+    for body in updates:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        await process_json(context, body)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - before)
+    tracemalloc.stop()
+    return peaks
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def bench_updates_async(args):
+    updates = generate_updates(args)
+    context = bench_context(args)
+
+    # Polls of all votebans share id -1, keep voting open
+    await context.db.put_voting(replace(INIT_VOTING, min_votes=10 ** 9))
+
+    wall, timings = await run_updates(context, updates, args.concurrency)
+    allocs = await measure_allocs(context, updates[:args.alloc_updates])
+
+    p50, p95, p99 = np.percentile(timings, [50, 95, 99]) * 1000
+    return {
+        'updates': len(updates),
+        'throughput': len(updates) / wall,
+        'p50_ms': p50,
+        'p95_ms': p95,
+        'p99_ms': p99,
+        'alloc_kib': np.mean(allocs) / 1024,
+    }
+
+
+def bench_updates(args):
+    # Mute logs, records still go through listener thread
+    devnull = open(os.devnull, 'w')
+    stream = LOG_HANDLER.setStream(devnull)
+    start_log_listener()
+    try:
+        results = asyncio.run(bench_updates_async(args))
+    finally:
+        stop_log_listener()
+        LOG_HANDLER.setStream(stream)
+        devnull.close()
+
+    record = {
+        'revision': git_revision(),
+        'time': int(time()),
+        'params': {
+            key: getattr(args, key)
+            for key in [
+                'updates', 'concurrency', 'mix', 'users',
+                'bot_latency', 'db_latency', 'moder_latency'
+            ]
+        },
+        'results': results,
+    }
+    print(format_record(record))
+
+    if args.output:
+        with open(args.output, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+
+
+def format_record(record):
+    results = record['results']
+    return (
+        f'{record["revision"]}, '
+        f'throughput={results["throughput"]:.0f}/s, '
+        f'p50={results["p50_ms"]:.2f}ms, '
+        f'p95={results["p95_ms"]:.2f}ms, '
+        f'p99={results["p99_ms"]:.2f}ms, '
+        f'alloc={results["alloc_kib"]:.1f}KiB/update'
+    )
+
+
+def bench_compare(args):
+    with open(args.path) as file:
+        for line in file:
+            print(format_record(json.loads(line)))
+
+
+######
+#
+#   LOADGEN
+#
+#####
+
+
+# Replay updates over HTTP against webhook from run(). By default bot
+# runs in subprocess, "bench.py serve", with same fakes as updates
+# bench. Recorded updates are JSONL, one Telegram Update per line, for
+# example collected from LoggingMiddleware output
+
+# Never point --url to deployed bot, it calls real Telegram API
+
+# Recorded updates carry update_id, file is repeated up to --updates
+# and every step resends same bodies. DedupMiddleware would drop
+# repeats as duplicate and bench would measure dedup fast path. Each
+# send gets fresh update_id, served bot must report zero duplicates
+
+LOADGEN_METRICS_TOKEN = 'token'
+DUPLICATE_METRIC = 'bandugan_updates_dropped_total{reason="duplicate"}'
+
+
+def bench_serve(args):
+    context = bench_context(args)
+    context.pipeline = Pipeline(enabled=args.pipeline)
+
+    # Polls of all votebans share id -1, keep voting open
+    context.db.votings.append(replace(INIT_VOTING, min_votes=10 ** 9))
+    context.metrics_token = LOADGEN_METRICS_TOKEN
+
+    # main.PORT is read from env, see serve_process
+    context.run()
+
+
+def serve_command(args):
+    command = [
+        sys.executable, os.path.abspath(__file__), 'serve',
+        '--bot-latency', str(args.bot_latency),
+        '--db-latency', str(args.db_latency),
+        '--moder-latency', str(args.moder_latency),
+    ]
+    if args.pipeline:
+        command.append('--pipeline')
+    return command
+
+
+@contextmanager
+def serve_process(args):
+    env = dict(os.environ, PORT=str(args.port))
+    process = subprocess.Popen(
+        serve_command(args), env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        yield process
+    finally:
+        # SIGTERM, aiohttp runs on_shutdown
+        process.terminate()
+        process.wait()
+
+
+async def wait_ready(session, url, timeout=30):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        try:
+            async with session.get(url) as response:
+                await response.read()
+                return
+        except aiohttp.ClientConnectionError:
+            if loop.time() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def load_updates(args):
+    if not args.path:
+        return generate_updates(args)
+
+    with open(args.path) as file:
+        updates = [_.strip() for _ in file if _.strip()]
+    if len(updates) < args.updates:
+        updates *= args.updates // len(updates) + 1
+    return updates[:args.updates]
+
+
+def renumber_updates(updates, update_ids):
+    bodies = []
+    for body in updates:
+        data = json.loads(body)
+        data['update_id'] = next(update_ids)
+        bodies.append(json.dumps(data))
+    return bodies
+
+
+async def fetch_duplicates(session, url, token):
+    async with session.get(
+            url + 'metrics',
+            headers={'Authorization': f'Bearer {token}'}
+    ) as response:
+        text = await response.text()
+    for line in text.splitlines():
+        if line.startswith(DUPLICATE_METRIC + ' '):
+            return int(line.split()[-1])
+    return 0
+
+
+async def send_update(session, url, body, scheduled=None):
+    # Open loop measures from scheduled arrival, not actual send, late
+    # sends due to client lag still count
+    loop = asyncio.get_running_loop()
+    start = scheduled or loop.time()
+    try:
+        async with session.post(
+                url, data=body,
+                headers={'Content-Type': 'application/json'}
+        ) as response:
+            await response.read()
+            ok = response.status == 200
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        ok = False
+    return loop.time() - start, ok
+
+
+async def closed_loop(session, url, updates, concurrency):
+    # Each worker sends next update after previous response
+    loop = asyncio.get_running_loop()
+    bodies = iter(updates)
+    results = []
+
+    async def worker():
+        for body in bodies:
+            results.append(await send_update(session, url, body))
+
+    start = loop.time()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return loop.time() - start, results
+
+
+async def open_loop(session, url, updates, rate):
+    # Fixed arrival rate, independent of responses
+    loop = asyncio.get_running_loop()
+    tasks = []
+
+    start = loop.time()
+    for index, body in enumerate(updates):
+        scheduled = start + index / rate
+        delay = scheduled - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(
+            send_update(session, url, body, scheduled)
+        ))
+
+    results = await asyncio.gather(*tasks)
+    return loop.time() - start, results
+
+
+def loadgen_step(wall, results):
+    timings = [timing for timing, _ in results]
+    errors = sum(not ok for _, ok in results)
+    p50, p95, p99 = np.percentile(timings, [50, 95, 99]) * 1000
+    return {
+        'updates': len(results),
+        'throughput': len(results) / wall,
+        'error_rate': errors / len(results),
+        'p50_ms': p50,
+        'p95_ms': p95,
+        'p99_ms': p99,
+    }
+
+
+def is_saturated(step, args):
+    if step['error_rate'] > args.max_error_rate:
+        return True
+    if step['p99_ms'] > args.slo * 1000:
+        return True
+    # Open loop, server falls behind arrival rate
+    rate = step.get('rate')
+    return rate and step['throughput'] < rate * 0.9
+
+
+async def loadgen_steps(args, updates, metrics_token=None):
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout
+    ) as session:
+        await wait_ready(session, args.url)
+
+        # Open loop sweeps rate, closed loop sweeps concurrency
+        if args.rate:
+            loads = [(rate, None) for rate in args.rate]
+        else:
+            loads = [(None, _) for _ in args.concurrency]
+
+        steps = []
+        update_ids = count(1)
+        for rate, concurrency in loads:
+            if rate:
+                size = int(rate * args.duration)
+                bodies = renumber_updates(updates[:size], update_ids)
+                wall, results = await open_loop(
+                    session, args.url, bodies, rate
+                )
+            else:
+                bodies = renumber_updates(updates, update_ids)
+                wall, results = await closed_loop(
+                    session, args.url, bodies, concurrency
+                )
+            step = loadgen_step(wall, results)
+            step['rate'] = rate
+            step['concurrency'] = concurrency
+            step['saturated'] = bool(is_saturated(step, args))
+            log(format_step(step))
+            steps.append(step)
+
+        if metrics_token:
+            duplicates = await fetch_duplicates(
+                session, args.url, metrics_token
+            )
+            log(f'duplicate drops={duplicates}')
+            assert not duplicates, 'replay resent update_id'
+        return steps
+
+
+def format_step(step):
+    if step['rate']:
+        load = f'rate={step["rate"]:g}/s'
+    else:
+        load = f'concurrency={step["concurrency"]}'
+    return (
+        f'{load}, '
+        f'throughput={step["throughput"]:.0f}/s, '
+        f'errors={step["error_rate"]:.2%}, '
+        f'p50={step["p50_ms"]:.2f}ms, '
+        f'p95={step["p95_ms"]:.2f}ms, '
+        f'p99={step["p99_ms"]:.2f}ms'
+        + (', saturated' if step['saturated'] else '')
+    )
+
+
+def parse_floats(value):
+    return [float(_) for _ in value.split(',')]
+
+
+def parse_ints(value):
+    return [int(_) for _ in value.split(',')]
+
+
+def bench_loadgen(args):
+    # Open loop needs rate * duration updates per step
+    if args.rate:
+        args.updates = max(args.updates, int(max(args.rate) * args.duration))
+    updates = load_updates(args)
+
+    rss = None
+    if args.url:
+        steps = asyncio.run(loadgen_steps(args, updates))
+    else:
+        args.url = f'http://127.0.0.1:{args.port}/'
+        with serve_process(args):
+            steps = asyncio.run(loadgen_steps(
+                args, updates,
+                metrics_token=LOADGEN_METRICS_TOKEN
+            ))
+        # Peak over waited children, bot subprocess dominates
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        rss = usage.ru_maxrss / 1024
+        log(f'server peak rss={rss:.1f}MiB')
+
+    saturated = [_ for _ in steps if _['saturated']]
+    if saturated:
+        log(f'saturation at {format_step(saturated[0])}')
+    else:
+        log('no saturation')
+
+    if args.output:
+        record = {
+            'revision': git_revision(),
+            'time': int(time()),
+            'params': {
+                key: getattr(args, key)
+                for key in [
+                    'path', 'rate', 'concurrency', 'duration',
+                    'mix', 'users', 'pipeline',
+                    'bot_latency', 'db_latency', 'moder_latency'
+                ]
+            },
+            'steps': steps,
+            'server_rss_mib': rss,
+        }
+        with open(args.output, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+
+
+######
+#
+#   WEBHOOK
+#
+#####
+
+
+# Webhook handler in process over local HTTP: aiogram
+# WebhookRequestHandler, same as executor.start_webhook, against
+# WebhookFilter. Mix has updates handlers ignore: other chats, edits,
+# joins
+
+
+async def bench_webhook_handler(args, handler, updates):
+    context = bench_context(args)
+    context.db.votings.append(replace(INIT_VOTING, min_votes=10 ** 9))
+
+    app = web.Application()
+    app[BOT_DISPATCHER_KEY] = context.dispatcher
+    app.router.add_post('/', handler)
+
+    async with TestServer(app) as server:
+        async with aiohttp.ClientSession() as session:
+            url = str(server.make_url('/'))
+            # Warm up connection and handlers
+            for body in updates[:100]:
+                await send_update(session, url, body)
+
+            wall, results = await closed_loop(
+                session, url, updates, args.concurrency
+            )
+
+    timings = [_ for _, ok in results if ok]
+    p50, p99 = np.percentile(timings, [50, 99]) * 1000
+    return {
+        'handler': handler.__name__,
+        'throughput': len(updates) / wall,
+        'p50_ms': p50,
+        'p99_ms': p99,
+        'errors': len(results) - len(timings),
+    }
+
+
+def bench_webhook(args):
+    updates = generate_updates(args)
+
+    devnull = open(os.devnull, 'w')
+    stream = LOG_HANDLER.setStream(devnull)
+    start_log_listener()
+    try:
+        for handler in [WebhookRequestHandler, WebhookFilter]:
+            record = asyncio.run(bench_webhook_handler(args, handler, updates))
+            log(
+                f'{record["handler"]}: '
+                f'throughput={record["throughput"]:.0f}/s, '
+                f'p50={record["p50_ms"]:.2f}ms, '
+                f'p99={record["p99_ms"]:.2f}ms, '
+                f'errors={record["errors"]}'
+            )
+    finally:
+        stop_log_listener()
+        LOG_HANDLER.setStream(stream)
+        devnull.close()
+
+
+######
+#
+#   STARTUP
+#
+#####
+
+
+# Time to first handled update of real main.py, as on serverless
+# container cold start. Update is from other chat, WebhookFilter drops
+# it before any backend call and marks first_update, dummy credentials
+# keep clients offline. Phases come from STARTUP_PROFILE log line
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+
+def post_until_ok(url, body, timeout):
+    request = urllib.request.Request(
+        url, data=body.encode(),
+        headers={'Content-Type': 'application/json'}
+    )
+    deadline = perf_counter() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return response.status
+        except OSError:
+            if perf_counter() > deadline:
+                raise
+            # Not listening yet
+            sleep(0.005)
+
+
+def startup_run(args, body):
+    env = dict(
+        os.environ,
+        PORT=str(args.port),
+        STARTUP_PROFILE='1',
+        BOT_TOKEN='1:token',
+        AWS_KEY_ID='key',
+        AWS_KEY='key',
+    )
+    url = f'http://127.0.0.1:{args.port}/'
+
+    start = perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, MAIN_PATH], env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    try:
+        post_until_ok(url, body, args.timeout)
+        duration = perf_counter() - start
+    finally:
+        process.terminate()
+        _, stderr = process.communicate()
+
+    phases = {}
+    for line in stderr.splitlines():
+        if line.startswith('{'):
+            record = json.loads(line)
+            if record['event'] == 'startup':
+                phases = record
+    return duration, phases
+
+
+def bench_startup(args):
+    body = message_json(CHAT_ID - 1, 'start')
+    durations, phases = [], {}
+    for _ in range(args.runs):
+        duration, record = startup_run(args, body)
+        durations.append(duration)
+        for name, value in record.items():
+            if name not in ('time', 'level', 'event'):
+                phases.setdefault(name, []).append(value)
+
+    p50 = np.median(durations) * 1000
+    log(
+        f'time to first update, p50={p50:.0f}ms, '
+        f'min={min(durations) * 1000:.0f}ms, '
+        f'max={max(durations) * 1000:.0f}ms'
+    )
+    phases = {
+        name: float(np.median(values))
+        for name, values in phases.items()
+    }
+    log(', '.join(
+        f'{name}={value * 1000:.0f}ms'
+        for name, value in phases.items()
+    ))
+
+    if args.output:
+        record = {
+            'revision': git_revision(),
+            'time': int(time()),
+            'params': {'runs': args.runs},
+            'results': {'p50_ms': p50, 'phases': phases},
+        }
+        with open(args.output, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+
+
+def add_latency_arguments(subparser):
+    subparser.add_argument('--bot-latency', type=float, default=0)
+    subparser.add_argument('--db-latency', type=float, default=0)
+    subparser.add_argument('--moder-latency', type=float, default=0)
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(required=True)
+
+    subparser = subparsers.add_parser('moder')
+    subparser.add_argument('corpus')
+    subparser.add_argument('model')
+    subparser.add_argument(
+        '--remote-latency', type=float, default=0.5,
+        help='seconds per remote predict'
+    )
+    subparser.set_defaults(bench=bench_moder)
+
+    subparser = subparsers.add_parser('codec')
+    subparser.add_argument('--number', type=int, default=10000)
+    subparser.set_defaults(bench=bench_codec)
+
+    subparser = subparsers.add_parser('db')
+    subparser.add_argument('--number', type=int, default=200)
+    subparser.set_defaults(bench=bench_db)
+
+    subparser = subparsers.add_parser('updates')
+    subparser.add_argument('--updates', type=int, default=5000)
+    subparser.add_argument('--concurrency', type=int, default=16)
+    subparser.add_argument(
+        '--mix', default='message=0.85,voteban=0.05,poll_answer=0.1'
+    )
+    subparser.add_argument('--users', type=int, default=200)
+    subparser.add_argument('--seed', type=int, default=0)
+    add_latency_arguments(subparser)
+    subparser.add_argument('--alloc-updates', type=int, default=500)
+    subparser.add_argument('--output', help='append results, JSONL')
+    subparser.set_defaults(bench=bench_updates)
+
+    subparser = subparsers.add_parser('compare')
+    subparser.add_argument('path')
+    subparser.set_defaults(bench=bench_compare)
+
+    subparser = subparsers.add_parser('webhook')
+    subparser.add_argument('--updates', type=int, default=5000)
+    subparser.add_argument('--concurrency', type=int, default=16)
+    subparser.add_argument(
+        '--mix',
+        default=(
+            'message=0.4,poll_answer=0.05,'
+            'foreign=0.25,edit=0.15,service=0.15'
+        )
+    )
+    subparser.add_argument('--users', type=int, default=200)
+    subparser.add_argument('--seed', type=int, default=0)
+    add_latency_arguments(subparser)
+    subparser.set_defaults(bench=bench_webhook)
+
+    subparser = subparsers.add_parser('serve')
+    add_latency_arguments(subparser)
+    subparser.add_argument('--pipeline', action='store_true')
+    subparser.set_defaults(bench=bench_serve)
+
+    subparser = subparsers.add_parser('loadgen')
+    subparser.add_argument('--path', help='recorded updates, JSONL')
+    subparser.add_argument('--url', help='running webhook, no serve')
+    subparser.add_argument('--port', type=int, default=8081)
+    subparser.add_argument(
+        '--rate', type=parse_floats,
+        help='open loop, updates/s, comma separated sweep'
+    )
+    subparser.add_argument(
+        '--concurrency', type=parse_ints, default=[1, 4, 16, 64],
+        help='closed loop, comma separated sweep'
+    )
+    subparser.add_argument(
+        '--duration', type=float, default=10,
+        help='seconds per open loop step'
+    )
+    subparser.add_argument('--updates', type=int, default=2000)
+    subparser.add_argument(
+        '--mix', default='message=0.85,voteban=0.05,poll_answer=0.1'
+    )
+    subparser.add_argument('--users', type=int, default=200)
+    subparser.add_argument('--seed', type=int, default=0)
+    subparser.add_argument('--pipeline', action='store_true')
+    add_latency_arguments(subparser)
+    subparser.add_argument(
+        '--timeout', type=float, default=30,
+        help='seconds, same as --execution-timeout'
+    )
+    subparser.add_argument(
+        '--slo', type=float, default=1,
+        help='seconds, p99 above is saturated'
+    )
+    subparser.add_argument('--max-error-rate', type=float, default=0.01)
+    subparser.add_argument('--output', help='append results, JSONL')
+    subparser.set_defaults(bench=bench_loadgen)
+
+    subparser = subparsers.add_parser('startup')
+    subparser.add_argument('--runs', type=int, default=5)
+    subparser.add_argument('--port', type=int, default=8082)
+    subparser.add_argument('--timeout', type=float, default=30)
+    subparser.add_argument('--output', help='append results, JSONL')
+    subparser.set_defaults(bench=bench_startup)
+
+    args = parser.parse_args(args)
+    args.bench(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,24 +1,85 @@
 
 import sys
-from os import getenv
+import json
+import random
+import logging
+from logging.handlers import (
+    QueueHandler,
+    QueueListener
+)
+from queue import SimpleQueue
+from os import (
+    getenv,
+    sysconf
+)
+import unicodedata
+from hashlib import blake2b
+from hmac import compare_digest
 from dataclasses import (
     dataclass,
-    fields
+    asdict,
+    fields,
+    replace,
+    MISSING
+)
+from typing import (
+    Union,
+    get_args,
+    get_origin
+)
+from functools import (
+    partial,
+    wraps
 )
+from itertools import count
+from heapq import (
+    heappush,
+    heappop
+)
+from bisect import bisect_left
 import asyncio
-from contextlib import AsyncExitStack
+from concurrent.futures import ThreadPoolExecutor
+from time import (
+    time,
+    monotonic,
+    perf_counter
+)
+from collections import (
+    OrderedDict,
+    deque
+)
+from contextlib import (
+    AsyncExitStack,
+    contextmanager
+)
 
 from aiogram import (
     Bot,
     Dispatcher,
-    executor,
     exceptions
 )
-from aiogram.types import ChatMemberStatus
+from aiogram.types import (
+    Update,
+    ChatMemberStatus
+)
 from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.webhook import (
+    WebhookRequestHandler,
+    BOT_DISPATCHER_KEY
+)
 
 import aiohttp
+from aiohttp import web
 import aiobotocore.session
+from aiobotocore.config import AioConfig
+from botocore.exceptions import ClientError
+
+# Optional, see WebhookFilter
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 #######
@@ -42,6 +103,39 @@ ADMIN_ID = int(getenv('ADMIN_ID'))
 
 MODER_API_TOKEN = getenv('MODER_API_TOKEN')
 
+# Optional, see train.py
+MODER_MODEL_PATH = getenv('MODER_MODEL_PATH')
+
+# Optional, see Moder.batch_predict
+MODER_BATCHING = bool(getenv('MODER_BATCHING'))
+
+# Optional, see Pipeline
+PIPELINE = bool(getenv('PIPELINE'))
+
+# Optional, see log_sampled. update=0.01,...
+LOG_SAMPLE = getenv('LOG_SAMPLE')
+
+# Optional, see StartupProfile
+STARTUP_PROFILE = bool(getenv('STARTUP_PROFILE'))
+
+# Optional, local SQLite instead of DynamoDB, see SqliteStore
+SQLITE_PATH = getenv('SQLITE_PATH')
+
+# Optional, see WRITE BEHIND
+USER_STATS_WRITE_BEHIND = bool(getenv('USER_STATS_WRITE_BEHIND'))
+
+# Optional, see DedupMiddleware
+DEDUP_DYNAMO = bool(getenv('DEDUP_DYNAMO'))
+
+# Optional, see Jobs
+JOBS_PERSIST = bool(getenv('JOBS_PERSIST'))
+
+# Optional, see handle_metrics. Without it /metrics is not served
+METRICS_TOKEN = getenv('METRICS_TOKEN')
+
+# Same as --concurrency in deploy, sizes connection pools
+CONTAINER_CONCURRENCY = int(getenv('CONTAINER_CONCURRENCY', 16))
+
 
 #####
 #
@@ -50,8 +144,368 @@ MODER_API_TOKEN = getenv('MODER_API_TOKEN')
 ######
 
 
-def log(message):
-    print(message, file=sys.stderr, flush=True)
+# JSON lines to stderr, YC Logging parses level and fields. While bot
+# runs, handler puts record to queue, listener thread formats and
+# writes, event loop never blocks on stderr. Listener is started in
+# on_startup, stopped in on_shutdown. Before and after, scripts and
+# tests, records are written in caller thread
+
+LOG_SAMPLE_RATES = {
+    'update': 0.01,
+}
+if LOG_SAMPLE:
+    for part in LOG_SAMPLE.split(','):
+        event, rate = part.split('=')
+        LOG_SAMPLE_RATES[event] = float(rate)
+
+# Longer strings are cut, hash kept to match same texts across lines
+LOG_MAX_LENGTH = 256
+
+# Never sampled or cut
+LOG_FULL_EVENTS = {'error', 'ban_decision'}
+
+
+def log_hash(value):
+    return blake2b(value.encode(), digest_size=8).hexdigest()
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+        }
+        full = record.msg['event'] in LOG_FULL_EVENTS
+        for key, value in record.msg.items():
+            if (
+                    not full
+                    and isinstance(value, str)
+                    and len(value) > LOG_MAX_LENGTH
+            ):
+                data[f'{key}_hash'] = log_hash(value)
+                value = value[:LOG_MAX_LENGTH] + '...'
+            data[key] = value
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class RecordQueueHandler(QueueHandler):
+    # Default prepare formats in caller thread, keep it in listener
+    def prepare(self, record):
+        return record
+
+
+LOG_QUEUE = SimpleQueue()
+LOG_HANDLER = logging.StreamHandler(sys.stderr)
+LOG_HANDLER.setFormatter(JSONFormatter())
+LOG_QUEUE_HANDLER = RecordQueueHandler(LOG_QUEUE)
+LOG_LISTENER = QueueListener(LOG_QUEUE, LOG_HANDLER)
+
+logger = logging.getLogger('bandugan')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(LOG_HANDLER)
+
+
+def log_listener_started():
+    return LOG_QUEUE_HANDLER in logger.handlers
+
+
+def start_log_listener():
+    if not log_listener_started():
+        LOG_LISTENER.start()
+        logger.addHandler(LOG_QUEUE_HANDLER)
+        logger.removeHandler(LOG_HANDLER)
+
+
+def stop_log_listener():
+    if log_listener_started():
+        logger.addHandler(LOG_HANDLER)
+        logger.removeHandler(LOG_QUEUE_HANDLER)
+        # Writes queued records
+        LOG_LISTENER.stop()
+
+
+def log_sampled(event):
+    if event in LOG_FULL_EVENTS:
+        return True
+    rate = LOG_SAMPLE_RATES.get(event, 1)
+    return rate >= 1 or random.random() < rate
+
+
+def log(event, **kwargs):
+    # Any event, rate from LOG_SAMPLE, default keeps all
+    if not log_sampled(event):
+        return
+
+    level = logging.ERROR if event == 'error' else logging.INFO
+    logger.log(level, {'event': event, **kwargs})
+
+
+######
+#
+#   METRICS
+#
+#####
+
+
+# Prometheus text format on GET /metrics, no client library. Observe
+# is bisect and two adds on plain lists, fine for hot path. Metrics
+# are module globals, like log. Webhook URL is public, scraper sends
+# "Authorization: Bearer $METRICS_TOKEN"
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+
+METRICS_PREFIX = 'bandugan'
+METRICS_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+
+class Counter:
+    def __init__(self, name, help, label):
+        self.name = f'{METRICS_PREFIX}_{name}'
+        self.help = help
+        self.label = label
+        self.series = {}
+
+    def inc(self, value):
+        self.series[value] = self.series.get(value, 0) + 1
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for value, total in self.series.items():
+            yield f'{self.name}{{{self.label}="{value}"}} {total}'
+
+
+class Histogram:
+    def __init__(self, name, help, label, buckets=METRICS_BUCKETS):
+        self.name = f'{METRICS_PREFIX}_{name}'
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+
+        # value -> [bucket counts, +Inf last], sum
+        self.series = {}
+
+    def observe(self, value, duration):
+        series = self.series.get(value)
+        if not series:
+            series = [[0] * (len(self.buckets) + 1), 0]
+            self.series[value] = series
+        series[0][bisect_left(self.buckets, duration)] += 1
+        series[1] += duration
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for value, (counts, total) in self.series.items():
+            label = f'{self.label}="{value}"'
+            cumulative = 0
+            for bound, number in zip(self.buckets + ('+Inf',), counts):
+                cumulative += number
+                yield (
+                    f'{self.name}_bucket{{{label},le="{bound}"}} '
+                    f'{cumulative}'
+                )
+            yield f'{self.name}_sum{{{label}}} {total}'
+            yield f'{self.name}_count{{{label}}} {cumulative}'
+
+
+HANDLER_SECONDS = Histogram(
+    'handler_seconds', 'Update handler latency', 'handler'
+)
+DYNAMO_SECONDS = Histogram(
+    'dynamo_seconds', 'DynamoDB op latency', 'op'
+)
+MODER_SECONDS = Histogram(
+    'moder_seconds', 'Remote moder latency', 'op'
+)
+BOT_SECONDS = Histogram(
+    'bot_seconds', 'Bot API method latency', 'method'
+)
+UPDATE_QUEUE_SECONDS = Histogram(
+    'update_queue_seconds', 'Update wait in keyed queue', 'type'
+)
+
+BANS = Counter('bans_total', 'Banned users', 'source')
+DROPPED = Counter('updates_dropped_total', 'Dropped updates', 'reason')
+VERDICTS = Counter('moder_verdicts_total', 'Moder verdicts', 'verdict')
+ERRORS = Counter('errors_total', 'Errors', 'source')
+CONDITIONAL_FAILED = Counter(
+    'conditional_failed_total', 'Failed DynamoDB conditions', 'op'
+)
+
+METRICS = [
+    HANDLER_SECONDS,
+    DYNAMO_SECONDS,
+    MODER_SECONDS,
+    BOT_SECONDS,
+    UPDATE_QUEUE_SECONDS,
+    BANS,
+    DROPPED,
+    VERDICTS,
+    ERRORS,
+    CONDITIONAL_FAILED,
+]
+
+
+def timed(histogram, value=None):
+    # Label value is function name by default. Error is counted under
+    # same value, then raised. Failed DynamoDB condition is normal path:
+    # closed poll, lost close race, duplicate claim. Own counter, keeps
+    # errors_total fit for alerts
+    def decorator(function):
+        label = value or function.__name__
+
+        @wraps(function)
+        async def wrapped(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except ClientError as error:
+                if is_conditional_check_failed(error):
+                    CONDITIONAL_FAILED.inc(label)
+                else:
+                    ERRORS.inc(label)
+                raise
+            except Exception:
+                ERRORS.inc(label)
+                raise
+            finally:
+                histogram.observe(label, perf_counter() - start)
+
+        return wrapped
+    return decorator
+
+
+def render_gauges(name, stats, label=None):
+    # stats from .stats() of caches, batch, pipeline, scheduler. With
+    # label, stats is {label value: stats}
+    if not label:
+        stats = {None: stats}
+    for value, record in stats.items():
+        labels = f'{{{label}="{value}"}}' if label else ''
+        for key, number in record.items():
+            yield f'{METRICS_PREFIX}_{name}_{key}{labels} {number}'
+
+
+def render_metrics(context):
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    db, moder, pipeline = context.db, context.moder, context.pipeline
+    lines.extend(render_gauges('cache', {
+        'user_stats': db.user_stats_cache.stats(),
+        'active_votings': db.active_votings.stats(),
+        'pred': moder.pred_cache.stats(),
+        'chat_admins': context.chat_admins.cache.stats(),
+    }, label='cache'))
+    lines.extend(render_gauges('moder_batch', moder.batch_stats()))
+    lines.extend(render_gauges('pool', {
+        'dynamo': db.pool_stats(),
+        'moder': moder.pool_stats(),
+    }, label='pool'))
+
+    stats = pipeline.stats()
+    lines.extend(render_gauges('pipeline', {'queued': stats['queued']}))
+    lines.extend(render_gauges('pipeline_stage', {
+        stage: {'count': _['count'], 'max_seconds': _['max']}
+        for stage, _ in stats['stages'].items()
+    }, label='stage'))
+
+    lines.extend(render_gauges('jobs', context.jobs.stats()))
+    lines.extend(render_gauges('update_queue', context.ordered.stats()))
+
+    if context.bot.scheduler:
+        lines.extend(render_gauges(
+            'bot_scheduler',
+            context.bot.scheduler.stats()
+        ))
+
+    return '\n'.join(lines) + '\n'
+
+
+######
+#   POOL
+#####
+
+
+# DynamoDB and moder clients live for container lifetime, warm
+# instance reuses keep-alive connections across updates. aiohttp has
+# no public pool stats, count in trace callbacks: requests on every
+# request, connections on new only, pool hit does not fire it.
+# requests / connections is reuse
+
+
+async def on_request_start(owner, session, context, params):
+    owner.requests += 1
+
+
+async def on_connection_create(owner, session, context, params):
+    owner.connections += 1
+
+
+def connection_trace_config(owner):
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(
+        partial(on_request_start, owner)
+    )
+    trace_config.on_connection_create_end.append(
+        partial(on_connection_create, owner)
+    )
+    trace_config.freeze()
+    return trace_config
+
+
+######
+#
+#   CACHE
+#
+#####
+
+
+class TTLCache:
+    # LRU, entry also expires after ttl seconds. Hit/miss counters to
+    # tune max_size against container memory
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        record = self.items.get(key)
+        if record:
+            value, expires = record
+            if expires > monotonic():
+                self.items.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.items[key]
+        self.misses += 1
+
+    def set(self, key, value):
+        self.items[key] = (value, monotonic() + self.ttl)
+        self.items.move_to_end(key)
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def pop(self, key):
+        self.items.pop(key, None)
+
+    def stats(self):
+        return {
+            'size': len(self.items),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
 
 
 ######
@@ -78,6 +532,14 @@ class Voting:
 
     min_votes: int
 
+    # Decided or stale, further answers are ignored
+    closed: bool = False
+
+    # Unix time. After deadline voting is closed on next answer, after
+    # expires_at DynamoDB TTL deletes the item. 0 for old items
+    deadline: int = 0
+    expires_at: int = 0
+
 
 @dataclass
 class UserStats:
@@ -102,7 +564,26 @@ class UserStats:
 ######
 
 
-async def dynamo_client():
+# Pool is shared by handlers and flush loop. Server side idle timeout
+# is unknown for YDB, keep-alive below usual 20s. Connect fails fast,
+# botocore retries
+# https://aiobotocore.readthedocs.io/en/latest/reference/config.html
+
+# aiobotocore 2.3 takes no aiohttp trace_configs, requests are counted
+# with botocore before-send event, new connections are not visible
+
+DYNAMO_POOL_SIZE = CONTAINER_CONCURRENCY
+DYNAMO_KEEPALIVE_TIMEOUT = 15
+DYNAMO_CONNECT_TIMEOUT = 2
+DYNAMO_READ_TIMEOUT = 5
+
+
+def on_dynamo_send(owner, **kwargs):
+    # Every attempt, retries too. None, not a response, sends request
+    owner.requests += 1
+
+
+async def dynamo_client(owner=None):
     session = aiobotocore.session.get_session()
     manager = session.create_client(
         'dynamodb',
@@ -114,11 +595,28 @@ async def dynamo_client():
         endpoint_url=DYNAMO_ENDPOINT,
         aws_access_key_id=AWS_KEY_ID,
         aws_secret_access_key=AWS_KEY,
+
+        config=AioConfig(
+            max_pool_connections=DYNAMO_POOL_SIZE,
+            connect_timeout=DYNAMO_CONNECT_TIMEOUT,
+            read_timeout=DYNAMO_READ_TIMEOUT,
+            connector_args={
+                'keepalive_timeout': DYNAMO_KEEPALIVE_TIMEOUT,
+                'use_dns_cache': True,
+            }
+        )
     )
 
     # https://github.com/aio-libs/aiobotocore/discussions/955
     exit_stack = AsyncExitStack()
     client = await exit_stack.enter_async_context(manager)
+
+    if owner:
+        client.meta.events.register(
+            'before-send.dynamodb',
+            partial(on_dynamo_send, owner)
+        )
+
     return exit_stack, client
 
 
@@ -127,13 +625,16 @@ async def dynamo_client():
 #####
 
 
-async def dynamo_put(client, table, item):
+@timed(DYNAMO_SECONDS)
+async def dynamo_put(client, table, item, **kwargs):
     await client.put_item(
         TableName=table,
-        Item=item
+        Item=item,
+        **kwargs
     )
 
 
+@timed(DYNAMO_SECONDS)
 async def dynamo_get(client, table, key_name, key_type, value):
     response = await client.get_item(
         TableName=table,
@@ -146,6 +647,7 @@ async def dynamo_get(client, table, key_name, key_type, value):
     return response.get('Item')
 
 
+@timed(DYNAMO_SECONDS)
 async def dynamo_delete(client, table, key_name, key_type, value):
     await client.delete_item(
         TableName=table,
@@ -157,61 +659,181 @@ async def dynamo_delete(client, table, key_name, key_type, value):
     )
 
 
+# UpdateItem is atomic on server side, no read-modify-write races
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.UpdateExpressions.html
+
+
+@timed(DYNAMO_SECONDS)
+async def dynamo_update(client, table, key_name, key_type, value, **kwargs):
+    response = await client.update_item(
+        TableName=table,
+        Key={
+            key_name: {
+                key_type: str(value)
+            }
+        },
+        **kwargs
+    )
+    return response.get('Attributes')
+
+
 ######
 #   DE/SER
 ####
 
 
-def dynamo_deser_value(value, annot):
-    if annot == int:
-        return int(value)
-    elif annot == str:
-        return value
-    elif annot == [int]:
-        return [int(_) for _ in value]
+# Codec per dataclass, per-field converters built once on first use.
+# No fields() lookup, no annotation compares per call
+
+# DynamoDB rejects empty sets, DELETE of the last element removes the
+# attribute. Empty list is stored as missing attribute, None too.
+# Items written before a field was added miss it, use dataclass
+# default
+
+
+NONE_TYPE = type(None)
+
+
+def identity(value):
+    return value
+
+
+def ser_int_list(values):
+    return [str(_) for _ in values]
+
 
+def deser_int_list(values):
+    return [int(_) for _ in values]
 
-def dynamo_ser_value(value, annot):
-    if annot == int:
-        return str(value)
-    elif annot == str:
-        return value
-    elif annot == [int]:
-        return [str(_) for _ in value]
 
+# annot -> key type, ser, deser
+ANNOT_CODECS = [
+    (int, 'N', str, int),
+    (float, 'N', repr, float),
+    (str, 'S', identity, identity),
+    (bool, 'BOOL', identity, identity),
+    ([int], 'NS', ser_int_list, deser_int_list),
+    ([str], 'SS', list, list),
+]
+
+SET_KEY_TYPES = {'NS', 'SS'}
+
+
+def unwrap_optional(annot):
+    if get_origin(annot) is Union:
+        args = [_ for _ in get_args(annot) if _ is not NONE_TYPE]
+        if len(args) == 1:
+            return args[0], True
+    return annot, False
+
+
+def annot_codec(annot):
+    for other, key_type, ser, deser in ANNOT_CODECS:
+        if annot == other:
+            return key_type, ser, deser
+    raise TypeError(f'unsupported annotation {annot!r}')
+
+
+def field_ser(name, key_type, ser, is_set, optional):
+    if is_set:
+        def ser_field(obj, item):
+            value = getattr(obj, name)
+            if value:
+                item[name] = {key_type: ser(value)}
+
+    elif optional:
+        def ser_field(obj, item):
+            value = getattr(obj, name)
+            if value is not None:
+                item[name] = {key_type: ser(value)}
+
+    else:
+        def ser_field(obj, item):
+            item[name] = {key_type: ser(getattr(obj, name))}
+
+    return ser_field
+
+
+def field_deser(name, key_type, deser, is_set, optional, has_default):
+    if has_default:
+        def deser_field(item, kwargs):
+            value = item.get(name)
+            if value is not None:
+                kwargs[name] = deser(value[key_type])
+
+    elif is_set or optional:
+        def deser_field(item, kwargs):
+            value = item.get(name)
+            if value is not None:
+                kwargs[name] = deser(value[key_type])
+            else:
+                kwargs[name] = [] if is_set else None
+
+    else:
+        def deser_field(item, kwargs):
+            kwargs[name] = deser(item[name][key_type])
+
+    return deser_field
 
-def obj_annots(obj):
-    for field in fields(obj):
-        yield field.name, field.type
+
+@dataclass
+class DynamoCodec:
+    ser: object
+    deser: object
+
+
+def build_dynamo_codec(cls):
+    ser_fields = []
+    deser_fields = []
+    for field in fields(cls):
+        annot, optional = unwrap_optional(field.type)
+        key_type, ser, deser = annot_codec(annot)
+        is_set = key_type in SET_KEY_TYPES
+        has_default = (
+            field.default is not MISSING
+            or field.default_factory is not MISSING
+        )
+        ser_fields.append(field_ser(
+            field.name, key_type, ser,
+            is_set, optional
+        ))
+        deser_fields.append(field_deser(
+            field.name, key_type, deser,
+            is_set, optional, has_default
+        ))
+
+    def ser(obj):
+        item = {}
+        for ser_field in ser_fields:
+            ser_field(obj, item)
+        return item
+
+    def deser(item):
+        kwargs = {}
+        for deser_field in deser_fields:
+            deser_field(item, kwargs)
+        return cls(**kwargs)
+
+    return DynamoCodec(ser, deser)
+
+
+DYNAMO_CODECS = {}
 
 
-def annot_key_type(annot):
-    if annot == int:
-        return 'N'
-    elif annot == str:
-        return 'S'
-    elif annot == [int]:
-        return 'NS'
+def dynamo_codec(cls):
+    codec = DYNAMO_CODECS.get(cls)
+    if not codec:
+        codec = build_dynamo_codec(cls)
+        DYNAMO_CODECS[cls] = codec
+    return codec
 
 
 def dynamo_deser_item(item, cls):
-    kwargs = {}
-    for key_name, annot in obj_annots(cls):
-        key_type = annot_key_type(annot)
-        value = item[key_name][key_type]
-        value = dynamo_deser_value(value, annot)
-        kwargs[key_name] = value
-    return cls(**kwargs)
+    return dynamo_codec(cls).deser(item)
 
 
 def dynamo_ser_obj(obj):
-    item = {}
-    for key_name, annot in obj_annots(obj):
-        value = getattr(obj, key_name)
-        value = dynamo_ser_value(value, annot)
-        key_type = annot_key_type(annot)
-        item[key_name] = {key_type: value}
-    return item
+    return dynamo_codec(type(obj)).ser(obj)
 
 
 # On DynamoDB partition key
@@ -229,149 +851,1558 @@ def dynamo_ser_key(parts):
 ######
 
 
-async def put_voting(db, obj):
+# Raw ops, no caches. Caches and write-behind live in DB, same for
+# DynamoStore and SqliteStore
+
+
+async def dynamo_put_voting(store, obj):
     item = dynamo_ser_obj(obj)
-    await dynamo_put(db.client, 'votings', item)
+    await dynamo_put(store.client, 'votings', item)
 
 
-async def get_voting(db, key):
+async def dynamo_get_voting(store, key):
     item = await dynamo_get(
-        db.client, 'votings',
+        store.client, 'votings',
         'poll_id', 'S', key
     )
     if item:
         return dynamo_deser_item(item, Voting)
 
 
-async def delete_voting(db, key):
+async def dynamo_delete_voting(store, key):
     await dynamo_delete(
-        db.client, 'votings',
+        store.client, 'votings',
         'poll_id', 'S', key
     )
 
 
-async def put_user_stats(db, obj):
+# Concurrent answers to a poll used to overwrite each other with
+# get_voting + put_voting. Single UpdateItem: ADD user to one number
+# set, DELETE from the other, revote and retract for free
+
+
+BAN_VOTE = 'ban'
+NO_BAN_VOTE = 'no_ban'
+
+VOTE_EXPRESSIONS = {
+    BAN_VOTE: 'ADD ban_user_ids :user_ids DELETE no_ban_user_ids :user_ids',
+    NO_BAN_VOTE: 'ADD no_ban_user_ids :user_ids DELETE ban_user_ids :user_ids',
+
+    # Retract vote, option_ids=[]
+    None: 'DELETE ban_user_ids :user_ids, no_ban_user_ids :user_ids',
+}
+
+
+def is_conditional_check_failed(error):
+    code = error.response.get('Error', {}).get('Code')
+    return code == 'ConditionalCheckFailedException'
+
+
+# Missing closed is open, items written before the field was added
+
+OPEN_VOTING_CONDITION = (
+    'attribute_exists(poll_id) '
+    'AND (attribute_not_exists(closed) OR closed = :false)'
+)
+
+
+async def dynamo_record_vote(store, poll_id, user_id, option):
+    try:
+        attributes = await dynamo_update(
+            store.client, 'votings',
+            'poll_id', 'S', poll_id,
+            UpdateExpression=VOTE_EXPRESSIONS[option],
+            ConditionExpression=OPEN_VOTING_CONDITION,
+            ExpressionAttributeValues={
+                ':user_ids': {'NS': [str(user_id)]},
+                ':false': {'BOOL': False},
+            },
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as error:
+        # Unknown or closed poll, UpdateItem would create an item
+        if is_conditional_check_failed(error):
+            return
+        raise
+    return dynamo_deser_item(attributes, Voting)
+
+
+async def dynamo_close_voting(store, poll_id):
+    # Conditional, of concurrent deciding answers only one gets voting
+    try:
+        attributes = await dynamo_update(
+            store.client, 'votings',
+            'poll_id', 'S', poll_id,
+            UpdateExpression='SET closed = :true',
+            ConditionExpression=OPEN_VOTING_CONDITION,
+            ExpressionAttributeValues={
+                ':true': {'BOOL': True},
+                ':false': {'BOOL': False},
+            },
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as error:
+        if is_conditional_check_failed(error):
+            return
+        raise
+    return dynamo_deser_item(attributes, Voting)
+
+
+def dynamo_ser_user_stats(obj):
     item = dynamo_ser_obj(obj)
     item['key'] = {'S': dynamo_ser_key(obj.key)}
-    await dynamo_put(db.client, 'user_stats', item)
+    return item
 
 
-async def get_user_stats(db, key):
+async def dynamo_put_user_stats(store, obj):
+    item = dynamo_ser_user_stats(obj)
+    await dynamo_put(store.client, 'user_stats', item)
+
+
+async def dynamo_get_user_stats(store, key):
     item = await dynamo_get(
-        db.client, 'user_stats',
+        store.client, 'user_stats',
         'key', 'S', dynamo_ser_key(key)
     )
     if item:
         return dynamo_deser_item(item, UserStats)
 
 
-async def delete_user_stats(db, key):
+async def dynamo_delete_user_stats(store, key):
     await dynamo_delete(
-        db.client, 'user_stats',
+        store.client, 'user_stats',
         'key', 'S', dynamo_ser_key(key)
     )
 
 
+async def dynamo_add_user_stats(store, key, delta):
+    chat_id, user_id = key
+    attributes = await dynamo_update(
+        store.client, 'user_stats',
+        'key', 'S', dynamo_ser_key(key),
+        UpdateExpression=(
+            'SET chat_id = :chat_id, user_id = :user_id '
+            'ADD message_count :delta'
+        ),
+        ExpressionAttributeValues={
+            ':chat_id': {'N': str(chat_id)},
+            ':user_id': {'N': str(user_id)},
+            ':delta': {'N': str(delta)},
+        },
+        ReturnValues='UPDATED_NEW'
+    )
+    return int(attributes['message_count']['N'])
+
+
+async def dynamo_add_user_stats_batch(store, deltas):
+    # No batch UpdateItem in DynamoDB, concurrent requests. Result per
+    # key, count or error
+    return await asyncio.gather(
+        *(dynamo_add_user_stats(store, *_) for _ in deltas),
+        return_exceptions=True
+    )
+
+
+# Cross-instance dedup, see DedupMiddleware. Conditional put fails if
+# other instance claimed update_id first. Item expires like votings
+
+UPDATE_CLAIM_TTL = 24 * 60 * 60
+
+
+async def dynamo_claim_update(store, update_id):
+    try:
+        await dynamo_put(
+            store.client, 'updates',
+            {
+                'update_id': {'N': str(update_id)},
+                'expires_at': {'N': str(int(time()) + UPDATE_CLAIM_TTL)},
+            },
+            ConditionExpression='attribute_not_exists(update_id)'
+        )
+    except ClientError as error:
+        if is_conditional_check_failed(error):
+            return False
+        raise
+    return True
+
+
+async def dynamo_release_update(store, update_id):
+    await dynamo_delete(
+        store.client, 'updates',
+        'update_id', 'N', update_id
+    )
+
+
+# Persisted Jobs, few items, loaded with Scan on startup. Item
+# expires a day after due, if never deleted
+
+JOB_TTL = 24 * 60 * 60
+
+
+def dynamo_ser_job(job):
+    return {
+        'job_id': {'S': job.job_id},
+        'name': {'S': job.name},
+        'due': {'N': repr(job.due)},
+        'kwargs': {'S': json.dumps(job.kwargs)},
+        'expires_at': {'N': str(int(job.due) + JOB_TTL)},
+    }
+
+
+def dynamo_deser_job(item):
+    return Job(
+        job_id=item['job_id']['S'],
+        name=item['name']['S'],
+        due=float(item['due']['N']),
+        kwargs=json.loads(item['kwargs']['S'])
+    )
+
+
+async def dynamo_put_job(store, job):
+    await dynamo_put(store.client, 'jobs', dynamo_ser_job(job))
+
+
+async def dynamo_delete_job(store, job_id):
+    await dynamo_delete(store.client, 'jobs', 'job_id', 'S', job_id)
+
+
+async def dynamo_get_jobs(store):
+    jobs, kwargs = [], {}
+    while True:
+        response = await store.client.scan(TableName='jobs', **kwargs)
+        jobs.extend(dynamo_deser_job(_) for _ in response['Items'])
+        key = response.get('LastEvaluatedKey')
+        if not key:
+            return jobs
+        kwargs['ExclusiveStartKey'] = key
+
+
+######
+#   STORE
 ######
-#  DB
-#######
 
 
-class DB:
+class DynamoStore:
+    def __init__(self):
+        self.exit_stack = None
+        self.client = None
+        self.requests = 0
+
     async def connect(self):
-        self.exit_stack, self.client = await dynamo_client()
+        self.exit_stack, self.client = await dynamo_client(owner=self)
 
     async def close(self):
         await self.exit_stack.aclose()
 
+    def pool_stats(self):
+        return {
+            'limit': DYNAMO_POOL_SIZE,
+            'requests': self.requests,
+        }
 
-DB.put_voting = put_voting
-DB.get_voting = get_voting
-DB.delete_voting = delete_voting
 
-DB.put_user_stats = put_user_stats
-DB.get_user_stats = get_user_stats
-DB.delete_user_stats = delete_user_stats
+DynamoStore.put_voting = dynamo_put_voting
+DynamoStore.get_voting = dynamo_get_voting
+DynamoStore.delete_voting = dynamo_delete_voting
+DynamoStore.record_vote = dynamo_record_vote
+DynamoStore.close_voting = dynamo_close_voting
+DynamoStore.claim_update = dynamo_claim_update
+DynamoStore.release_update = dynamo_release_update
+DynamoStore.put_job = dynamo_put_job
+DynamoStore.delete_job = dynamo_delete_job
+DynamoStore.get_jobs = dynamo_get_jobs
+
+DynamoStore.put_user_stats = dynamo_put_user_stats
+DynamoStore.get_user_stats = dynamo_get_user_stats
+DynamoStore.delete_user_stats = dynamo_delete_user_stats
+DynamoStore.add_user_stats = dynamo_add_user_stats
+DynamoStore.add_user_stats_batch = dynamo_add_user_stats_batch
+
+
+######
+#
+#   SQLITE
+#
+######
+
+
+# Embedded store, same raw ops as DynamoStore, no network round trip
+# per op. State is a local file: fits single long-lived instance (VM,
+# volume mount), not serverless scale-out where every instance has own
+# disk. Caches and write-behind come from DB.
+
+# One worker thread owns connection, calls are serialized, so
+# read-modify-write in a transaction is atomic. sqlite3 keeps prepared
+# statements per connection for constant SQL strings
+# https://www.sqlite.org/wal.html
+
+SQLITE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS votings (
+        poll_id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        expires_at INTEGER NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS updates (
+        update_id INTEGER PRIMARY KEY,
+        expires_at INTEGER NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS jobs (
+        job_id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        due REAL NOT NULL,
+        kwargs TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS user_stats (
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        message_count INTEGER NOT NULL,
+        PRIMARY KEY (chat_id, user_id)
+    )''',
+]
+
+
+@contextmanager
+def sql_transaction(connection):
+    # Autocommit connection, write lock taken at BEGIN
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+def sql_connect(path):
+    # Optional store, keep import off cold start, same as numpy
+    import sqlite3
+
+    connection = sqlite3.connect(
+        path,
+        isolation_level=None,
+        check_same_thread=False
+    )
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    for sql in SQLITE_SCHEMA:
+        connection.execute(sql)
+
+    # Same as DynamoDB TTL on expires_at
+    for table in ['votings', 'updates']:
+        connection.execute(
+            f'DELETE FROM {table} WHERE expires_at > 0 AND expires_at < ?',
+            (int(time()),)
+        )
+    return connection
+
+
+def sql_close(connection):
+    connection.close()
+
+
+def sql_put_voting(connection, obj):
+    connection.execute(
+        'INSERT OR REPLACE INTO votings VALUES (?, ?, ?)',
+        (obj.poll_id, json.dumps(asdict(obj)), obj.expires_at)
+    )
+
+
+def sql_get_voting(connection, poll_id):
+    row = connection.execute(
+        'SELECT data FROM votings WHERE poll_id = ?',
+        (poll_id,)
+    ).fetchone()
+    if row:
+        return Voting(**json.loads(row[0]))
+
+
+def sql_delete_voting(connection, poll_id):
+    connection.execute(
+        'DELETE FROM votings WHERE poll_id = ?',
+        (poll_id,)
+    )
+
+
+def sql_record_vote(connection, poll_id, user_id, option):
+    with sql_transaction(connection):
+        obj = sql_get_voting(connection, poll_id)
+        if not obj or obj.closed:
+            return
+
+        # Same as ADD/DELETE of VOTE_EXPRESSIONS
+        obj.ban_user_ids = [_ for _ in obj.ban_user_ids if _ != user_id]
+        obj.no_ban_user_ids = [
+            _ for _ in obj.no_ban_user_ids
+            if _ != user_id
+        ]
+        if option == BAN_VOTE:
+            obj.ban_user_ids.append(user_id)
+        elif option == NO_BAN_VOTE:
+            obj.no_ban_user_ids.append(user_id)
+
+        sql_put_voting(connection, obj)
+        return obj
+
+
+def sql_close_voting(connection, poll_id):
+    with sql_transaction(connection):
+        obj = sql_get_voting(connection, poll_id)
+        if not obj or obj.closed:
+            return
+
+        obj.closed = True
+        sql_put_voting(connection, obj)
+        return obj
+
+
+def sql_claim_update(connection, update_id):
+    cursor = connection.execute(
+        'INSERT OR IGNORE INTO updates VALUES (?, ?)',
+        (update_id, int(time()) + UPDATE_CLAIM_TTL)
+    )
+    return cursor.rowcount == 1
+
+
+def sql_release_update(connection, update_id):
+    connection.execute(
+        'DELETE FROM updates WHERE update_id = ?',
+        (update_id,)
+    )
+
+
+def sql_put_job(connection, job):
+    connection.execute(
+        'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)',
+        (job.job_id, job.name, job.due, json.dumps(job.kwargs))
+    )
+
+
+def sql_delete_job(connection, job_id):
+    connection.execute(
+        'DELETE FROM jobs WHERE job_id = ?',
+        (job_id,)
+    )
+
+
+def sql_get_jobs(connection):
+    rows = connection.execute(
+        'SELECT job_id, name, due, kwargs FROM jobs'
+    )
+    return [
+        Job(job_id, name, due, json.loads(kwargs))
+        for job_id, name, due, kwargs in rows
+    ]
+
+
+def sql_put_user_stats(connection, obj):
+    connection.execute(
+        'INSERT OR REPLACE INTO user_stats VALUES (?, ?, ?)',
+        (obj.chat_id, obj.user_id, obj.message_count)
+    )
+
+
+def sql_get_user_stats(connection, key):
+    row = connection.execute(
+        'SELECT message_count FROM user_stats '
+        'WHERE chat_id = ? AND user_id = ?',
+        key
+    ).fetchone()
+    if row:
+        chat_id, user_id = key
+        return UserStats(chat_id, user_id, row[0])
+
+
+def sql_delete_user_stats(connection, key):
+    connection.execute(
+        'DELETE FROM user_stats WHERE chat_id = ? AND user_id = ?',
+        key
+    )
+
+
+SQL_ADD_USER_STATS = (
+    'INSERT INTO user_stats VALUES (?, ?, ?) '
+    'ON CONFLICT (chat_id, user_id) '
+    'DO UPDATE SET message_count = message_count + ?'
+)
+
+
+def sql_add_user_stats(connection, key, delta):
+    chat_id, user_id = key
+    with sql_transaction(connection):
+        connection.execute(
+            SQL_ADD_USER_STATS,
+            (chat_id, user_id, delta, delta)
+        )
+        return sql_get_user_stats(connection, key).message_count
+
+
+def sql_add_user_stats_batch(connection, deltas):
+    # Single executor job and transaction for whole flush
+    with sql_transaction(connection):
+        connection.executemany(SQL_ADD_USER_STATS, [
+            (chat_id, user_id, delta, delta)
+            for (chat_id, user_id), delta in deltas
+        ])
+        return [
+            sql_get_user_stats(connection, key).message_count
+            for key, _ in deltas
+        ]
+
+
+def sqlite_method(function):
+    async def method(store, *args):
+        return await store.run(function, *args)
+
+    return method
+
+
+class SqliteStore:
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self.connection = None
+        self.executor = None
+
+    async def run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            partial(function, self.connection, *args)
+        )
+
+    async def connect(self):
+        self.executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='sqlite'
+        )
+        loop = asyncio.get_running_loop()
+        self.connection = await loop.run_in_executor(
+            self.executor,
+            partial(sql_connect, self.path)
+        )
+
+    async def close(self):
+        await self.run(sql_close)
+        self.executor.shutdown()
+
+    def pool_stats(self):
+        # Single connection, calls in executor thread
+        return {'limit': 1}
+
+
+SqliteStore.put_voting = sqlite_method(sql_put_voting)
+SqliteStore.get_voting = sqlite_method(sql_get_voting)
+SqliteStore.delete_voting = sqlite_method(sql_delete_voting)
+SqliteStore.record_vote = sqlite_method(sql_record_vote)
+SqliteStore.close_voting = sqlite_method(sql_close_voting)
+SqliteStore.claim_update = sqlite_method(sql_claim_update)
+SqliteStore.release_update = sqlite_method(sql_release_update)
+SqliteStore.put_job = sqlite_method(sql_put_job)
+SqliteStore.delete_job = sqlite_method(sql_delete_job)
+SqliteStore.get_jobs = sqlite_method(sql_get_jobs)
+
+SqliteStore.put_user_stats = sqlite_method(sql_put_user_stats)
+SqliteStore.get_user_stats = sqlite_method(sql_get_user_stats)
+SqliteStore.delete_user_stats = sqlite_method(sql_delete_user_stats)
+SqliteStore.add_user_stats = sqlite_method(sql_add_user_stats)
+SqliteStore.add_user_stats_batch = sqlite_method(sql_add_user_stats_batch)
+
+
+######
+#
+#  DB
+#
+#######
+
+
+######
+#   CACHE
+######
+
+
+# Only a handful of polls are active at a time. Keep them in memory,
+# writes go through to store. After container restart cache is empty,
+# read from store
+
+
+ACTIVE_VOTINGS_SIZE = 100
+ACTIVE_VOTINGS_TTL = 24 * 60 * 60
+
+
+async def put_voting(db, obj):
+    await db.store.put_voting(obj)
+    db.active_votings.set(obj.poll_id, replace(obj))
+
+
+async def get_voting(db, key):
+    obj = db.active_votings.get(key)
+    if not obj:
+        obj = await db.store.get_voting(key)
+        if not obj:
+            return
+        db.active_votings.set(key, obj)
+    return replace(obj)
+
+
+async def delete_voting(db, key):
+    db.active_votings.pop(key)
+    await db.store.delete_voting(key)
+
+
+async def record_vote(db, poll_id, user_id, option):
+    # Late answers to closed voting stop in memory
+    obj = db.active_votings.get(poll_id)
+    if obj and obj.closed:
+        return
+
+    obj = await db.store.record_vote(poll_id, user_id, option)
+    if not obj:
+        db.active_votings.pop(poll_id)
+        return
+
+    db.active_votings.set(poll_id, obj)
+    return replace(obj)
+
+
+async def close_voting(db, poll_id):
+    # Of concurrent deciding answers only one gets True
+    obj = await db.store.close_voting(poll_id)
+    if not obj:
+        db.active_votings.pop(poll_id)
+        return False
+
+    # Closed voting stays in cache, late answers stop there
+    db.active_votings.set(poll_id, obj)
+    return True
+
+
+async def put_user_stats(db, obj):
+    async with user_stats_lock(db):
+        db.user_stats_buffer.pop(obj.key, None)
+        db.user_stats_cache.pop(obj.key)
+        await db.store.put_user_stats(obj)
+
+
+async def get_user_stats(db, key):
+    obj = db.user_stats_cache.get(key)
+    if not obj:
+        obj = await db.store.get_user_stats(key)
+
+        # Store misses buffered, not yet flushed deltas
+        pending = user_stats_pending(db, key)
+        if pending:
+            chat_id, user_id = key
+            obj = obj or UserStats(chat_id, user_id, message_count=0)
+            obj.message_count += pending
+        if not obj:
+            return
+        db.user_stats_cache.set(key, obj)
+    return replace(obj)
+
+
+async def delete_user_stats(db, key):
+    async with user_stats_lock(db):
+        db.user_stats_buffer.pop(key, None)
+        db.user_stats_cache.pop(key)
+        await db.store.delete_user_stats(key)
+
+
+async def atomic_increment_user_stats(db, key):
+    message_count = await db.store.add_user_stats(key, 1)
+    chat_id, user_id = key
+    db.user_stats_cache.set(key, UserStats(chat_id, user_id, message_count))
+    return message_count
+
+
+async def claim_update(db, update_id):
+    return await db.store.claim_update(update_id)
+
+
+async def release_update(db, update_id):
+    await db.store.release_update(update_id)
+
+
+async def put_job(db, job):
+    await db.store.put_job(job)
+
+
+async def delete_job(db, job_id):
+    await db.store.delete_job(job_id)
+
+
+async def get_jobs(db):
+    return await db.store.get_jobs()
+
+
+######
+#   WRITE BEHIND
+######
+
+
+# Every message bumps user_stats. Buffer counter deltas in memory,
+# merge increments of the same user, flush them with UpdateItem ADD.
+# First message of a user costs one read, the rest cost nothing until
+# flush. ADD is atomic, increments from many containers add up.
+
+# Off by default, USER_STATS_WRITE_BEHIND. Deltas live in memory until
+# flush: instance killed or frozen before on_shutdown loses them, flush
+# loop only runs while instance gets CPU. Counter only gates moderation
+# of new users, with write-behind off every message is one UpdateItem
+
+
+USER_STATS_FLUSH_SIZE = 25
+USER_STATS_FLUSH_DELAY = 5
+
+
+def user_stats_pending(db, key):
+    return (
+        db.user_stats_buffer.get(key, 0)
+        + db.user_stats_flushing.get(key, 0)
+    )
+
+
+def user_stats_lock(db):
+    # Explicit put/delete waits for running flush, otherwise flushed ADD
+    # lands after and overwrites it
+    if not db.user_stats_flush_lock:
+        db.user_stats_flush_lock = asyncio.Lock()
+    return db.user_stats_flush_lock
+
+
+async def buffered_increment_user_stats(db, key, obj=None):
+    if not obj:
+        # Read includes pending deltas, also of other message of the
+        # same user buffered while awaiting
+        obj = await db.get_user_stats(key)
+        if not obj:
+            chat_id, user_id = key
+            obj = UserStats(chat_id, user_id, message_count=0)
+        db.user_stats_cache.set(key, obj)
+
+    obj.message_count += 1
+    db.user_stats_buffer[key] = db.user_stats_buffer.get(key, 0) + 1
+
+    if (
+            len(db.user_stats_buffer) >= db.user_stats_flush_size
+            and not user_stats_lock(db).locked()
+    ):
+        await db.safe_flush_user_stats()
+
+    return obj.message_count
+
+
+# Handlers skip moderation for users with many messages. Once cached
+# as trusted, counter is no longer updated, no DB round trips. Spam
+# resets counter, flood of spam does not earn trust
+
+TRUSTED_MESSAGE_COUNT = 10
+
+USER_STATS_CACHE_SIZE = 10000
+USER_STATS_CACHE_TTL = 60 * 60
+
+
+async def increment_user_stats(db, key):
+    obj = db.user_stats_cache.get(key)
+    if obj and obj.message_count >= TRUSTED_MESSAGE_COUNT:
+        return obj.message_count
+
+    if db.write_behind:
+        return await db.buffered_increment_user_stats(key, obj)
+    return await db.atomic_increment_user_stats(key)
+
+
+async def flush_user_stats(db):
+    async with user_stats_lock(db):
+        if not db.user_stats_buffer:
+            return
+
+        db.user_stats_flushing = db.user_stats_buffer
+        db.user_stats_buffer = {}
+        db.user_stats_flushed = monotonic()
+
+        deltas = list(db.user_stats_flushing.items())
+        errors = []
+        try:
+            for index in range(0, len(deltas), USER_STATS_FLUSH_SIZE):
+                batch = deltas[index:index + USER_STATS_FLUSH_SIZE]
+                try:
+                    results = await db.store.add_user_stats_batch(batch)
+                except Exception as error:
+                    # SQLite transaction failed as a whole
+                    results = [error] * len(batch)
+                for (key, delta), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        # Keep for next flush
+                        db.user_stats_buffer[key] = (
+                            db.user_stats_buffer.get(key, 0) + delta
+                        )
+                        errors.append(result)
+                    else:
+                        # Store count has increments of other instances
+                        chat_id, user_id = key
+                        db.user_stats_cache.set(key, UserStats(
+                            chat_id, user_id,
+                            result + db.user_stats_buffer.get(key, 0)
+                        ))
+        finally:
+            db.user_stats_flushing = {}
+
+        if errors:
+            raise errors[0]
+
+
+async def safe_flush_user_stats(db):
+    try:
+        await db.flush_user_stats()
+    except Exception as error:
+        log('error', source='DB.flush_user_stats', error=repr(error))
+
+
+async def flush_user_stats_loop(db):
+    while True:
+        await asyncio.sleep(db.user_stats_flush_delay)
+        delay = monotonic() - db.user_stats_flushed
+        if delay >= db.user_stats_flush_delay:
+            # Cancel on close does not drop deltas of running flush
+            await asyncio.shield(db.safe_flush_user_stats())
+
+
+######
+#   DB
+######
+
+
+class DB:
+    def __init__(
+            self,
+            store=None,
+            write_behind=USER_STATS_WRITE_BEHIND,
+            user_stats_flush_size=USER_STATS_FLUSH_SIZE,
+            user_stats_flush_delay=USER_STATS_FLUSH_DELAY,
+            user_stats_cache_size=USER_STATS_CACHE_SIZE,
+            user_stats_cache_ttl=USER_STATS_CACHE_TTL
+    ):
+        self.store = store or DynamoStore()
+
+        self.write_behind = write_behind
+        self.user_stats_flush_size = user_stats_flush_size
+        self.user_stats_flush_delay = user_stats_flush_delay
+
+        self.user_stats_buffer = {}
+        self.user_stats_flushing = {}
+        self.user_stats_flushed = monotonic()
+        self.user_stats_flush_lock = None
+
+        self.user_stats_cache = TTLCache(
+            user_stats_cache_size,
+            user_stats_cache_ttl
+        )
+        self.active_votings = TTLCache(
+            ACTIVE_VOTINGS_SIZE,
+            ACTIVE_VOTINGS_TTL
+        )
+
+        self.flush_task = None
+
+    async def connect(self):
+        await self.store.connect()
+        if self.write_behind:
+            self.flush_task = asyncio.create_task(
+                flush_user_stats_loop(self)
+            )
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+        await self.safe_flush_user_stats()
+        await self.store.close()
+
+    def pool_stats(self):
+        return self.store.pool_stats()
+
+
+DB.put_voting = put_voting
+DB.get_voting = get_voting
+DB.delete_voting = delete_voting
+DB.record_vote = record_vote
+DB.close_voting = close_voting
+DB.claim_update = claim_update
+DB.release_update = release_update
+DB.put_job = put_job
+DB.delete_job = delete_job
+DB.get_jobs = get_jobs
+
+DB.put_user_stats = put_user_stats
+DB.get_user_stats = get_user_stats
+DB.delete_user_stats = delete_user_stats
+DB.increment_user_stats = increment_user_stats
+DB.atomic_increment_user_stats = atomic_increment_user_stats
+DB.buffered_increment_user_stats = buffered_increment_user_stats
+DB.flush_user_stats = flush_user_stats
+DB.safe_flush_user_stats = safe_flush_user_stats
+
+
+######
+#
+#   MODER
+#
+#####
+
+
+######
+#   PRED CACHE
+######
+
+
+# Spam waves paste the same text from many fresh accounts, spammers
+# add invisible chars, mix Latin and Cyrillic lookalikes to defeat
+# exact match. Normalize, cache remote verdict by hash
+
+
+ZERO_WIDTH_CHARS = dict.fromkeys(map(ord, [
+    '\u00ad',  # soft hyphen
+    '\u180e',  # mongolian vowel separator
+    '\u200b',  # zero width space
+    '\u200c',  # zero width non-joiner
+    '\u200d',  # zero width joiner
+    '\u200e',  # left-to-right mark
+    '\u200f',  # right-to-left mark
+    '\u2060',  # word joiner
+    '\ufeff',  # zero width no-break space
+]))
+
+# After casefold. Fold Cyrillic to Latin, "Н" and "H" both -> "h"
+HOMOGLYPHS = str.maketrans(
+    'аеёорсхукмтнвіјѕԁ',
+    'aeeopcxykmthbijsd'
+)
+
+
+def normalize_text(text):
+    text = unicodedata.normalize('NFKC', text)
+    text = text.translate(ZERO_WIDTH_CHARS)
+    text = text.casefold()
+    text = text.translate(HOMOGLYPHS)
+    return ' '.join(text.split())
+
+
+def pred_cache_key(text):
+    text = normalize_text(text or '')
+    return blake2b(text.encode(), digest_size=16).digest()
+
+
+PRED_CACHE_SIZE = 10000
+PRED_CACHE_TTL = 60 * 60
+
+MODER_BATCH_WINDOW = 0.05
+MODER_BATCH_SIZE = 16
+MODER_MAX_INFLIGHT = 4
+
+
+# Remote API behind plain HTTP, own pool. DNS cached for minutes,
+# IP is stable. Connect fails fast, BERT read takes up to seconds.
+# Total bounds whole request, slow trickle resets sock_read, keep it
+# well below container timeout 30s
+
+MODER_POOL_SIZE = CONTAINER_CONCURRENCY
+MODER_KEEPALIVE_TIMEOUT = 30
+MODER_DNS_TTL = 300
+MODER_CONNECT_TIMEOUT = 2
+MODER_READ_TIMEOUT = 10
+MODER_TOTAL_TIMEOUT = 10
+
+
+class Moder:
+    def __init__(
+            self,
+            api_token=MODER_API_TOKEN,
+            pred_cache_size=PRED_CACHE_SIZE,
+            pred_cache_ttl=PRED_CACHE_TTL,
+            local_model_path=MODER_MODEL_PATH,
+            batching=MODER_BATCHING,
+            batch_window=MODER_BATCH_WINDOW,
+            batch_size=MODER_BATCH_SIZE,
+            max_inflight=MODER_MAX_INFLIGHT
+    ):
+        self.api_token = api_token
+        self.pred_cache = TTLCache(pred_cache_size, pred_cache_ttl)
+        self.pred_inflight = {}
+
+        self.local_model_path = local_model_path
+        self.local_model = None
+
+        self.batching = batching
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.max_inflight = max_inflight
+
+        self.batch_queue = []
+        self.batch_timer = None
+        self.batch_tasks = set()
+        self.batch_inflight = 0
+        self.inflight_semaphore = None
+
+        self.session = None
+        self.requests = 0
+        self.connections = 0
+
+    async def connect(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=MODER_POOL_SIZE,
+                keepalive_timeout=MODER_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=MODER_DNS_TTL
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=MODER_TOTAL_TIMEOUT,
+                sock_connect=MODER_CONNECT_TIMEOUT,
+                sock_read=MODER_READ_TIMEOUT
+            ),
+            trace_configs=[connection_trace_config(self)]
+        )
+        if self.local_model_path:
+            self.local_model = load_local_model(self.local_model_path)
+
+    async def close(self):
+        await self.session.close()
+
+    def pool_stats(self):
+        return {
+            'limit': MODER_POOL_SIZE,
+            'requests': self.requests,
+            'connections': self.connections,
+        }
+
+
+class ModerError(Exception):
+    pass
+
+
+@dataclass
+class ModerPred:
+    is_spam: bool
+    confidence: float
+
+
+@timed(MODER_SECONDS)
+async def predict(moder, text):
+    try:
+        response = await moder.session.post(
+            'http://pywebsolutions.ru:30/predict',
+            json={
+                'api_token': moder.api_token,
+                'text': text,
+                'model': 'bert'
+            }
+        )
+    except (
+            aiohttp.ClientError,
+            asyncio.TimeoutError
+    ) as error:
+        raise ModerError(str(error))
+
+    if response.status != 200:
+        raise ModerError(await response.text())
+
+    # {
+    #   "class": 0,
+    #   "time_taken": 0.041809797286987305,
+    #   "class_names": {
+    #     "0": "not spam",
+    #     "1": "spam"
+    #   },
+    #   "confidence": 73.92,
+    #   "unique_id": "rcVskO5aGy5DPyp-Lj-",
+    #   "balance": 199.60000000000002,
+    #   "server_id": 1,
+    #   "status": "ok"
+    # }
+
+    data = await response.json()
+    return ModerPred(
+        is_spam=data['class'] == 1,
+        confidence=data['confidence']
+    )
+
+
+async def safe_predict(moder, text):
+    key = pred_cache_key(text)
+    pred = moder.pred_cache.get(key)
+    if pred:
+        return pred
+
+    pred = moder.local_predict(text)
+    if pred:
+        return pred
+
+    # Raid pastes the same text at once, share single request
+    future = moder.pred_inflight.get(key)
+    if future:
+        return await future
+
+    future = asyncio.get_running_loop().create_future()
+    moder.pred_inflight[key] = future
+
+    pred = None
+    try:
+        if moder.batching:
+            pred = await moder.batch_predict(text)
+        else:
+            pred = await moder.predict(text)
+        moder.pred_cache.set(key, pred)
+    except ModerError as error:
+        log('error', source='Moder.predict', error=repr(error))
+    finally:
+        del moder.pred_inflight[key]
+        future.set_result(pred)
+
+    return pred
+
+
+Moder.predict = predict
+Moder.safe_predict = safe_predict
+
+
+######
+#   BATCH
+#####
+
+
+# Raid sends many predicts at once. Collect texts for batch_window
+# or up to batch_size, pass to predict_batch. Remote API takes single
+# text, so predict_batch fans out with at most max_inflight requests.
+# Batch endpoint would override predict_batch with one request
+
+
+async def predict_batch(moder, texts):
+    if not moder.inflight_semaphore:
+        moder.inflight_semaphore = asyncio.Semaphore(moder.max_inflight)
+
+    async def predict_one(text):
+        async with moder.inflight_semaphore:
+            return await moder.predict(text)
+
+    return await asyncio.gather(
+        *(predict_one(_) for _ in texts),
+        return_exceptions=True
+    )
+
+
+async def run_batch(moder, batch):
+    texts = [text for text, _ in batch]
+    moder.batch_inflight += len(batch)
+    try:
+        results = await moder.predict_batch(texts)
+    except ModerError as error:
+        results = [error] * len(batch)
+    finally:
+        moder.batch_inflight -= len(batch)
+
+    for (_, future), result in zip(batch, results):
+        if future.done():
+            continue
+        if isinstance(result, BaseException):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+
+def flush_batch(moder):
+    if moder.batch_timer:
+        moder.batch_timer.cancel()
+        moder.batch_timer = None
+
+    batch = moder.batch_queue
+    moder.batch_queue = []
+    if batch:
+        task = asyncio.create_task(run_batch(moder, batch))
+        moder.batch_tasks.add(task)
+        task.add_done_callback(moder.batch_tasks.discard)
+
+
+async def batch_predict(moder, text):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    moder.batch_queue.append((text, future))
+
+    if len(moder.batch_queue) >= moder.batch_size:
+        moder.flush_batch()
+    elif not moder.batch_timer:
+        moder.batch_timer = loop.call_later(
+            moder.batch_window,
+            moder.flush_batch
+        )
+
+    return await future
+
+
+def batch_stats(moder):
+    return {
+        'queued': len(moder.batch_queue),
+        'inflight': moder.batch_inflight,
+    }
+
+
+Moder.predict_batch = predict_batch
+Moder.batch_predict = batch_predict
+Moder.flush_batch = flush_batch
+Moder.batch_stats = batch_stats
+
+
+######
+#   LOCAL
+#####
+
+
+# Cascade. Linear model over hashed char n-grams decides confident
+# ham/spam in microseconds, only uncertain band goes to remote BERT.
+# Train and export with train.py
+
+# numpy is imported on first use, ~100ms of cold start without
+# MODER_MODEL_PATH
+
+
+@dataclass
+class LocalModel:
+    weights: object  # numpy.ndarray
+    bias: float
+    ngram_sizes: [int]
+
+    # p(spam) <= ham_threshold -> ham, >= spam_threshold -> spam
+    ham_threshold: float
+    spam_threshold: float
+
+
+NGRAM_HASH_PRIME = 0x100000001b3
+NGRAM_HASH_SHIFT = 29
+
+
+def text_ngram_ids(text, ngram_sizes, dim):
+    import numpy as np
+
+    prime = np.uint64(NGRAM_HASH_PRIME)
+    shift = np.uint64(NGRAM_HASH_SHIFT)
+
+    text = ' %s ' % normalize_text(text or '')
+    codes = np.frombuffer(
+        text.encode('utf-32-le'),
+        dtype=np.uint32
+    ).astype(np.uint64)
+
+    # Rolling polynomial hash of all n-grams at once, uint64 wraps
+    hashes = []
+    for size in ngram_sizes:
+        count = len(codes) - size + 1
+        if count < 1:
+            continue
+        ngram_hashes = np.full(count, size, dtype=np.uint64)
+        for offset in range(size):
+            ngram_hashes *= prime
+            ngram_hashes += codes[offset:offset + count]
+        hashes.append(ngram_hashes)
+
+    # Padded empty text is 2 chars, shorter than all sizes
+    if not hashes:
+        return np.empty(0, dtype=np.intp)
+
+    hashes = np.concatenate(hashes)
+    hashes ^= hashes >> shift
+    return (hashes % np.uint64(dim)).astype(np.intp)
+
+
+def local_model_score(model, ids):
+    # Sum of weights, scaled by sqrt of n-gram count, long messages
+    # do not saturate
+    import numpy as np
+
+    z = model.weights[ids].sum() / np.sqrt(len(ids)) + model.bias
+    return float(1 / (1 + np.exp(-z)))
+
+
+def load_local_model(path):
+    import numpy as np
+
+    with np.load(path) as data:
+        return LocalModel(
+            weights=data['weights'],
+            bias=float(data['bias']),
+            ngram_sizes=[int(_) for _ in data['ngram_sizes']],
+            ham_threshold=float(data['ham_threshold']),
+            spam_threshold=float(data['spam_threshold']),
+        )
+
+
+def save_local_model(model, path):
+    import numpy as np
+
+    np.savez_compressed(
+        path,
+        weights=model.weights,
+        bias=model.bias,
+        ngram_sizes=model.ngram_sizes,
+        ham_threshold=model.ham_threshold,
+        spam_threshold=model.spam_threshold,
+    )
+
+
+def local_predict(moder, text):
+    model = moder.local_model
+    if not model:
+        return
+
+    ids = text_ngram_ids(text, model.ngram_sizes, len(model.weights))
+    if not len(ids):
+        # No n-grams, no score, remote decides
+        return
+
+    score = local_model_score(model, ids)
+
+    # Same scale as remote, percent of predicted class
+    if score <= model.ham_threshold:
+        return ModerPred(
+            is_spam=False,
+            confidence=round((1 - score) * 100, 2)
+        )
+    elif score >= model.spam_threshold:
+        return ModerPred(
+            is_spam=True,
+            confidence=round(score * 100, 2)
+        )
+
+
+Moder.local_predict = local_predict
 
 
 ######
 #
-#   MODER
+#   PIPELINE
 #
 #####
 
 
-class Moder:
-    def __init__(self, api_token=MODER_API_TOKEN):
-        self.api_token = api_token
+# Moderation waits for remote predict up to 10s, ban takes several Bot
+# API calls, all that holds Telegram webhook request. With PIPELINE
+# handler puts moderation job to bounded queue and returns, webhook
+# gets 200 right away. Full queue blocks the handler, backpressure.
 
-    async def connect(self):
-        self.session = aiohttp.ClientSession()
+# Serverless container may throttle CPU when no request is running,
+# then jobs progress with next requests. on_shutdown drains the queue
 
-    async def close(self):
-        await self.session.close()
 
+PIPELINE_WORKERS = 4
+PIPELINE_QUEUE_SIZE = 64
 
-class ModerError(Exception):
-    pass
 
+class Pipeline:
+    def __init__(
+            self,
+            enabled=PIPELINE,
+            workers=PIPELINE_WORKERS,
+            queue_size=PIPELINE_QUEUE_SIZE
+    ):
+        self.enabled = enabled
+        self.workers = workers
+        self.queue_size = queue_size
+
+        self.queue = None
+        self.worker_tasks = []
+
+        # stage -> (count, total, max) seconds
+        self.stage_latency = {}
+
+    def observe(self, stage, duration):
+        count, total, max_duration = self.stage_latency.get(stage, (0, 0, 0))
+        self.stage_latency[stage] = (
+            count + 1,
+            total + duration,
+            max(max_duration, duration)
+        )
 
-@dataclass
-class ModerPred:
-    is_spam: bool
-    confidence: float
+    @contextmanager
+    def stage(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start)
+
+    async def start(self):
+        if not self.enabled:
+            return
+
+        self.queue = asyncio.Queue(self.queue_size)
+        self.worker_tasks = [
+            asyncio.create_task(self.work())
+            for _ in range(self.workers)
+        ]
+
+    async def submit(self, job, *args):
+        if not self.queue:
+            await job(*args)
+            return
+
+        await self.queue.put((monotonic(), job, args))
+
+    async def work(self):
+        while True:
+            enqueued, job, args = await self.queue.get()
+            self.observe('queue', monotonic() - enqueued)
+            try:
+                await job(*args)
+            except Exception as error:
+                log('error', source='Pipeline.work', error=repr(error))
+            finally:
+                self.queue.task_done()
+
+    async def drain(self):
+        if not self.queue:
+            return
+
+        await self.queue.join()
+        for task in self.worker_tasks:
+            task.cancel()
+        self.queue = None
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize() if self.queue else 0,
+            'stages': {
+                stage: {
+                    'count': count,
+                    'mean': total / count,
+                    'max': max_duration,
+                }
+                for stage, (count, total, max_duration)
+                in self.stage_latency.items()
+            }
+        }
 
 
-async def predict(moder, text):
-    try:
-        response = await moder.session.post(
-            'http://pywebsolutions.ru:30/predict',
-            timeout=10,
-            json={
-                'api_token': moder.api_token,
-                'text': text,
-                'model': 'bert'
-            }
-        )
-    except (
-            aiohttp.ClientError,
-            asyncio.TimeoutError
-    ) as error:
-        raise ModerError(str(error))
+######
+#
+#   JOBS
+#
+#####
 
-    if response.status != 200:
-        raise ModerError(await response.text())
 
-    # {
-    #   "class": 0,
-    #   "time_taken": 0.041809797286987305,
-    #   "class_names": {
-    #     "0": "not spam",
-    #     "1": "spam"
-    #   },
-    #   "confidence": 73.92,
-    #   "unique_id": "rcVskO5aGy5DPyp-Lj-",
-    #   "balance": 199.60000000000002,
-    #   "server_id": 1,
-    #   "status": "ok"
-    # }
+# Delayed Bot API calls, "delete in 5s" used to sleep inside handler
+# and hold webhook request. Handler schedules job and returns. Heap
+# of due times, single loop timer armed for the earliest job.
 
-    data = await response.json()
-    return ModerPred(
-        is_spam=data['class'] == 1,
-        confidence=data['confidence']
-    )
+# Job is name of context method "<name>_job" and JSON kwargs. With
+# JOBS_PERSIST jobs are also written to DB and loaded on startup, so
+# they survive container recycling. Otherwise on shutdown pending
+# JOBS_RUN_EARLY jobs run early, messages are not left behind, others
+# are dropped: closing every voting on recycle is worse than leaving
+# it to next answer after deadline
 
+JOBS_RUN_EARLY = {'delete_messages'}
 
-async def safe_predict(moder, *args):
-    try:
-        return await moder.predict(*args)
-    except ModerError as error:
-        log(f'source=Moder.predict, error={error!r}')
 
+@dataclass
+class Job:
+    job_id: str
+    name: str
+    due: float
+    kwargs: dict
+
+    def __lt__(self, other):
+        return self.due < other.due
+
+
+class Jobs:
+    def __init__(self, context, persist=JOBS_PERSIST):
+        self.context = context
+        self.persist = persist
+
+        self.heap = []
+        self.seq = count()
+        self.timer = None
+        self.tasks = set()
+
+        self.done = 0
+        self.failed = 0
+
+    def push(self, job):
+        heappush(self.heap, job)
+        self.arm()
+
+    def arm(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.heap:
+            loop = asyncio.get_running_loop()
+            delay = max(self.heap[0].due - time(), 0)
+            self.timer = loop.call_later(delay, self.fire)
+
+    def fire(self):
+        self.timer = None
+        now = time()
+        while self.heap and self.heap[0].due <= now:
+            self.spawn(heappop(self.heap))
+        self.arm()
+
+    def spawn(self, job):
+        task = asyncio.create_task(self.run(job))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def schedule(self, delay, name, **kwargs):
+        job = Job(
+            job_id=f'{time():.6f}-{next(self.seq)}',
+            name=name,
+            due=time() + delay,
+            kwargs=kwargs
+        )
+        if self.persist:
+            await self.context.db.put_job(job)
+        self.push(job)
 
-Moder.predict = predict
-Moder.safe_predict = safe_predict
+    async def run(self, job):
+        method = getattr(self.context, f'{job.name}_job')
+        try:
+            await method(**job.kwargs)
+            self.done += 1
+        except Exception as error:
+            self.failed += 1
+            log('error', source=f'Jobs.{job.name}', error=repr(error))
+
+        if self.persist:
+            await self.context.db.delete_job(job.job_id)
+
+    async def start(self):
+        if self.persist:
+            for job in await self.context.db.get_jobs():
+                self.push(job)
+
+    async def flush(self):
+        # Run all pending now, wait for running
+        while self.heap:
+            self.spawn(heappop(self.heap))
+        self.arm()
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+
+    async def close(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if not self.persist:
+            self.heap = [
+                job for job in self.heap
+                if job.name in JOBS_RUN_EARLY
+            ]
+            await self.flush()
+        elif self.tasks:
+            await asyncio.wait(self.tasks)
+
+    def stats(self):
+        return {
+            'pending': len(self.heap),
+            'running': len(self.tasks),
+            'done': self.done,
+            'failed': self.failed,
+        }
 
 
 #####
@@ -407,8 +2438,90 @@ VOTING_BAN_TEXT = 'voting ban'
 READ_DELAY = 5
 MIN_VOTES = 10
 
+# Stale voting is closed by job at deadline, or on next answer after
+# deadline if job was lost, the late answer is stored but not acted
+# on. Closed voting is kept until TTL to ignore late answers without
+# writes
+VOTING_DEADLINE = 24 * 60 * 60
+VOTING_TTL = 7 * 24 * 60 * 60
+
+
+# /voteban checks candidate is not admin. getChatMember per command,
+# troll burst of /voteban was burst of Bot API calls. Admin set per
+# chat from getChatAdministrators, kept for TTL. chat_member and
+# my_chat_member updates drop the chat, promote/demote seen at once.
+# Telegram sends chat_member only if listed in allowed_updates, see
+# setWebhook in README
+
+CHAT_ADMINS_CACHE_SIZE = 100
+CHAT_ADMINS_TTL = 10 * 60
+
+
+class ChatAdmins:
+    def __init__(
+            self, bot,
+            cache_size=CHAT_ADMINS_CACHE_SIZE,
+            ttl=CHAT_ADMINS_TTL
+    ):
+        self.bot = bot
+        self.cache = TTLCache(cache_size, ttl)
+        self.loads = {}
+
+    async def load(self, chat_id):
+        members = await self.bot.get_chat_administrators(chat_id=chat_id)
+        return frozenset(_.user.id for _ in members)
+
+    async def get(self, chat_id):
+        user_ids = self.cache.get(chat_id)
+        if user_ids is not None:
+            return user_ids
+
+        # Burst of misses waits for single request. Load started
+        # before invalidate is not cached
+        task = self.loads.get(chat_id)
+        if not task:
+            task = asyncio.create_task(self.load(chat_id))
+            self.loads[chat_id] = task
+        try:
+            user_ids = await asyncio.shield(task)
+        finally:
+            current = self.loads.get(chat_id) is task
+            if current:
+                del self.loads[chat_id]
+
+        if current:
+            self.cache.set(chat_id, user_ids)
+        return user_ids
+
+    async def is_admin(self, chat_id, user_id):
+        return user_id in await self.get(chat_id)
+
+    def invalidate(self, chat_id):
+        self.cache.pop(chat_id)
+        self.loads.pop(chat_id, None)
+
+
+# Joins and leaves of plain members are most of chat_member updates,
+# admin set changes only if admin or creator on either side
+
 
+def admin_status_changed(update):
+    return (
+        ChatMemberStatus.is_chat_admin(update.old_chat_member.status)
+        or ChatMemberStatus.is_chat_admin(update.new_chat_member.status)
+    )
+
+
+@timed(HANDLER_SECONDS)
+async def handle_chat_member(context, update):
+    if admin_status_changed(update):
+        context.chat_admins.invalidate(update.chat.id)
+
+
+@timed(HANDLER_SECONDS)
 async def handle_my_chat_member(context, update):
+    if admin_status_changed(update):
+        context.chat_admins.invalidate(update.chat.id)
     if (
             update.old_chat_member.status == ChatMemberStatus.LEFT
             and ChatMemberStatus.is_chat_member(update.new_chat_member.status)
@@ -424,55 +2537,74 @@ async def reply_delay_cleanup(context, message, text):
         reply_to_message_id=message.message_id
     )
     if reply_message:
-        await context.sleep(READ_DELAY)
-        await context.bot.safe_delete_message(
+        # Give time to read, handler returns now
+        await context.jobs.schedule(
+            READ_DELAY, 'delete_messages',
             chat_id=message.chat.id,
-            message_id=message.message_id
+            message_ids=[
+                message.message_id,
+                reply_message.message_id
+            ]
         )
-        await context.bot.delete_message(
-            chat_id=reply_message.chat.id,
-            message_id=reply_message.message_id
+
+
+async def delete_messages_job(context, chat_id, message_ids):
+    for message_id in message_ids:
+        await context.bot.safe_delete_message(
+            chat_id=chat_id,
+            message_id=message_id
         )
 
 
+async def moderate_message(context, message):
+    with context.pipeline.stage('predict'):
+        text = message.text or message.caption
+        pred = await context.moder.safe_predict(text)
+
+    if not pred:
+        return
+
+    VERDICTS.inc('spam' if pred.is_spam else 'ham')
+    if not pred.is_spam:
+        return
+
+    BANS.inc('moder')
+    await context.db.delete_user_stats(
+        (message.chat.id, message.from_user.id)
+    )
+    log(
+        'ban_decision',
+        source='moder',
+        decision=BAN_VOTE,
+        chat_id=message.chat.id,
+        user_id=message.from_user.id,
+        message_id=message.message_id,
+        confidence=pred.confidence,
+        text=text
+    )
+    with context.pipeline.stage('enforce'):
+        await run_plan(ban_plan(
+            context.bot,
+            chat_id=message.chat.id,
+            user_id=message.from_user.id,
+            message_id=message.message_id,
+            admin_text=MODER_BAN_TEXT.format(
+                confidence=pred.confidence
+            )
+        ))
+
+
+@timed(HANDLER_SECONDS)
 async def handle_message(context, message):
     chat_id = message.chat.id
     if chat_id != CHAT_ID:
         return
 
     user_id = message.from_user.id
-    user_stats = await context.db.get_user_stats((chat_id, user_id))
-    if not user_stats:
-        user_stats = UserStats(
-            chat_id, user_id,
-            message_count=0
-        )
-    user_stats.message_count += 1
-    await context.db.put_user_stats(user_stats)
+    message_count = await context.db.increment_user_stats((chat_id, user_id))
 
-    if user_stats.message_count < 10:
-        text = message.text or message.caption
-        pred = await context.moder.safe_predict(text)
-        if pred and pred.is_spam:
-            await context.bot.safe_ban_chat_member(
-                chat_id=chat_id,
-                user_id=user_id,
-            )
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=MODER_BAN_TEXT.format(
-                    confidence=pred.confidence
-                )
-            )
-            await context.bot.safe_forward_message(
-                chat_id=ADMIN_ID,
-                from_chat_id=chat_id,
-                message_id=message.message_id
-            )
-            await context.bot.safe_delete_message(
-                chat_id=chat_id,
-                message_id=message.message_id
-            )
+    if message_count < TRUSTED_MESSAGE_COUNT:
+        await context.pipeline.submit(context.moderate_message, message)
 
     if message.text not in VOTEBAN_TEXTS:
         return
@@ -487,11 +2619,10 @@ async def handle_message(context, message):
     candidate_message_id = message.reply_to_message.message_id
     candidate_user = message.reply_to_message.from_user
 
-    member = await context.bot.get_chat_member(
-        chat_id=message.chat.id,
-        user_id=candidate_user.id
-    )
-    if ChatMemberStatus.is_chat_admin(member.status):
+    if await context.chat_admins.is_admin(
+            message.chat.id,
+            candidate_user.id
+    ):
         await reply_delay_cleanup(
             context, message,
             text=IS_ADMIN_TEXT.format(
@@ -529,64 +2660,113 @@ async def handle_message(context, message):
         no_ban_user_ids=[],
 
         min_votes=MIN_VOTES,
+
+        deadline=int(time()) + VOTING_DEADLINE,
+        expires_at=int(time()) + VOTING_TTL,
     )
     await context.db.put_voting(voting)
+    await context.jobs.schedule(
+        VOTING_DEADLINE, 'close_voting',
+        poll_id=voting.poll_id
+    )
 
 
-async def handle_poll_answer(context, poll_answer):
-    voting = await context.db.get_voting(poll_answer.poll_id)
+async def close_voting_job(context, poll_id):
+    voting = await context.db.get_voting(poll_id)
+    if (
+            voting and not voting.closed
+            and await context.db.close_voting(poll_id)
+    ):
+        await run_plan(close_plan(context.bot, voting))
+
 
-    # revote
-    user_id = poll_answer.user.id
-    for user_ids in [voting.ban_user_ids, voting.no_ban_user_ids]:
-        if user_id in user_ids:
-            user_ids.remove(user_id)
+def close_plan(bot, voting):
+    return [
+        Action('delete_start', partial(
+            bot.safe_delete_message,
+            chat_id=voting.chat_id,
+            message_id=voting.start_message_id
+        )),
+        Action('delete_poll', partial(
+            bot.safe_delete_message,
+            chat_id=voting.chat_id,
+            message_id=voting.poll_message_id
+        )),
+    ]
 
+
+@timed(HANDLER_SECONDS)
+async def handle_poll_answer(context, poll_answer):
+    option = None
     if poll_answer.option_ids:
         # allows_multiple_answers=False
         option_id = poll_answer.option_ids[0]
         option_text = OPTION_TEXTS[option_id]
 
         if option_text == BAN_TEXT:
-            voting.ban_user_ids.append(user_id)
+            option = BAN_VOTE
         elif option_text == NO_BAN_TEXT:
-            voting.no_ban_user_ids.append(user_id)
+            option = NO_BAN_VOTE
+
+    # Single round trip, record_vote rejects unknown and closed polls,
+    # closed are rejected from memory
+    voting = await context.db.record_vote(
+        poll_answer.poll_id,
+        poll_answer.user.id,
+        option
+    )
+    if not voting:
+        return
+
+    # Late answer to stale voting closes it without decision
+    if voting.deadline and time() >= voting.deadline:
+        if await context.db.close_voting(voting.poll_id):
+            await run_plan(close_plan(context.bot, voting))
+        return
 
     ban = len(voting.ban_user_ids) >= voting.min_votes
     no_ban = len(voting.no_ban_user_ids) >= voting.min_votes
-    if ban or no_ban:
-        if ban:
-            await context.bot.safe_ban_chat_member(
-                chat_id=voting.chat_id,
-                user_id=voting.candidate_user_id,
-            )
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=VOTING_BAN_TEXT
-            )
-            await context.bot.safe_forward_message(
-                chat_id=ADMIN_ID,
-                from_chat_id=voting.chat_id,
-                message_id=voting.candidate_message_id
-            )
-            await context.bot.safe_delete_message(
-                chat_id=voting.chat_id,
-                message_id=voting.candidate_message_id
-            )
+    if not ban and not no_ban:
+        return
 
-        for message_id in [voting.start_message_id, voting.poll_message_id]:
-            await context.bot.safe_delete_message(
-                chat_id=voting.chat_id,
-                message_id=message_id
-            )
+    # Concurrent answer could decide first
+    if not await context.db.close_voting(voting.poll_id):
+        return
 
-    await context.db.put_voting(voting)
+    log(
+        'ban_decision',
+        source='voting',
+        decision=BAN_VOTE if ban else NO_BAN_VOTE,
+        poll_id=voting.poll_id,
+        chat_id=voting.chat_id,
+        user_id=voting.candidate_user_id,
+        message_id=voting.candidate_message_id,
+        starter_user_id=voting.starter_user_id,
+        ban_user_ids=voting.ban_user_ids,
+        no_ban_user_ids=voting.no_ban_user_ids
+    )
+
+    actions = []
+    if ban:
+        BANS.inc('voting')
+        actions.extend(ban_plan(
+            context.bot,
+            chat_id=voting.chat_id,
+            user_id=voting.candidate_user_id,
+            message_id=voting.candidate_message_id,
+            admin_text=VOTING_BAN_TEXT
+        ))
+    actions.extend(close_plan(context.bot, voting))
+    await run_plan(actions)
 
 
 def setup_handlers(context):
     context.dispatcher.register_my_chat_member_handler(
         context.handle_my_chat_member
     )
+    context.dispatcher.register_chat_member_handler(
+        context.handle_chat_member
+    )
     context.dispatcher.register_message_handler(
         context.handle_message
     )
@@ -602,15 +2782,203 @@ def setup_handlers(context):
 #####
 
 
+def update_log_fields(update):
+    record = {'update_id': update.update_id}
+    message = update.message or update.edited_message
+    if message:
+        record.update(
+            type='message',
+            chat_id=message.chat.id,
+            user_id=message.from_user and message.from_user.id,
+            message_id=message.message_id,
+            text=message.text or message.caption
+        )
+    elif update.poll_answer:
+        record.update(
+            type='poll_answer',
+            poll_id=update.poll_answer.poll_id,
+            user_id=update.poll_answer.user.id,
+            option_ids=update.poll_answer.option_ids
+        )
+    elif update.my_chat_member:
+        record.update(
+            type='my_chat_member',
+            chat_id=update.my_chat_member.chat.id,
+            user_id=update.my_chat_member.from_user.id,
+            status=update.my_chat_member.new_chat_member.status
+        )
+    elif update.chat_member:
+        record.update(
+            type='chat_member',
+            chat_id=update.chat_member.chat.id,
+            user_id=update.chat_member.new_chat_member.user.id,
+            status=update.chat_member.new_chat_member.status
+        )
+    return record
+
+
 class LoggingMiddleware(BaseMiddleware):
     async def on_pre_process_update(self, update, data):
-        log(f'source=LoggingMiddleware, update={update}')
+        log('update', **update_log_fields(update))
+
+
+# Telegram redelivers update when webhook answers slow or not 200.
+# Redelivery would count message twice, pay moder again, repeat ban
+# and admin forward. Drop seen and in-flight update_id. Window is per
+# instance. With DEDUP_DYNAMO update_id is also claimed in DB, other
+# instances drop it too. Failed update is forgotten, redelivery
+# retries it. Telegram keeps undelivered updates for 24 hours
+
+DEDUP_SIZE = 10000
+DEDUP_TTL = 24 * 60 * 60
+
+
+class DedupMiddleware(BaseMiddleware):
+    def __init__(
+            self, db,
+            claim=DEDUP_DYNAMO,
+            size=DEDUP_SIZE,
+            ttl=DEDUP_TTL
+    ):
+        BaseMiddleware.__init__(self)
+        self.db = db
+        self.claim = claim
+        self.seen = TTLCache(size, ttl)
+
+    async def on_pre_process_update(self, update, data):
+        update_id = update.update_id
+        if update_id is None:
+            return
+
+        if self.seen.get(update_id):
+            DROPPED.inc('duplicate')
+            raise CancelHandler
+
+        self.seen.set(update_id, True)
+        if self.claim and not await self.db.claim_update(update_id):
+            DROPPED.inc('duplicate')
+            raise CancelHandler
+
+    async def on_pre_process_error(self, update, error, data):
+        update_id = update.update_id
+        if update_id is None:
+            return
+
+        self.seen.pop(update_id)
+        if self.claim:
+            await self.db.release_update(update_id)
+
+
+# Webhook runs up to CONTAINER_CONCURRENCY updates at once. Two
+# updates of the same user or poll interleave read-modify-write of
+# user_stats and votings. Updates with same key run one by one in
+# arrival order, different keys run concurrently. Key is (chat_id,
+# user_id) for message, poll_id for poll answer, other updates are
+# not ordered.
+
+# Bounded: over ORDERED_QUEUE_SIZE admitted updates next one waits,
+# backpressure. Update is never dropped: dedup already claimed it,
+# webhook gets 200, no redelivery. Flood from single user is exactly
+# what moder has to see, poll key is shared by all voters. Long key
+# queue waits its turn, bound follows container concurrency
+
+ORDERED_QUEUE_SIZE = CONTAINER_CONCURRENCY
+
+
+def update_order_key(update):
+    message = update.message
+    if message:
+        return (message.chat.id, message.from_user and message.from_user.id)
+    elif update.poll_answer:
+        return update.poll_answer.poll_id
+
+
+class OrderedExecutor:
+    def __init__(self, queue_size=ORDERED_QUEUE_SIZE):
+        self.queue_size = queue_size
+
+        # key -> deque of futures, head is running
+        self.keys = {}
+        self.slots = None
+        self.admitted = 0
+
+    async def acquire(self, key):
+        if not self.slots:
+            self.slots = asyncio.Semaphore(self.queue_size)
+        await self.slots.acquire()
+        self.admitted += 1
+
+        future = asyncio.get_running_loop().create_future()
+        waiters = self.keys.setdefault(key, deque())
+        waiters.append(future)
+        if len(waiters) == 1:
+            future.set_result(None)
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            self.release(key, future)
+            raise
+        return future
+
+    def release(self, key, future):
+        waiters = self.keys[key]
+        if waiters[0] is future:
+            waiters.popleft()
+            if waiters:
+                waiters[0].set_result(None)
+        else:
+            waiters.remove(future)
+        if not waiters:
+            del self.keys[key]
+
+        self.admitted -= 1
+        self.slots.release()
+
+    def stats(self):
+        return {
+            'keys': len(self.keys),
+            'admitted': self.admitted,
+            'waiting': self.admitted - len(self.keys),
+        }
+
+
+class OrderedMiddleware(BaseMiddleware):
+    def __init__(self, executor):
+        BaseMiddleware.__init__(self)
+        self.executor = executor
+
+    async def on_pre_process_update(self, update, data):
+        key = update_order_key(update)
+        if key is None:
+            return
+
+        kind = 'message' if update.message else 'poll_answer'
+        start = monotonic()
+        future = await self.executor.acquire(key)
+        UPDATE_QUEUE_SECONDS.observe(kind, monotonic() - start)
+        data['order'] = (key, future)
+
+    async def on_post_process_update(self, update, results, data):
+        if 'order' in data:
+            self.executor.release(*data.pop('order'))
 
 
 def setup_middlewares(context):
     middleware = LoggingMiddleware()
     context.dispatcher.middleware.setup(middleware)
 
+    middleware = DedupMiddleware(context.db)
+    context.dispatcher.middleware.setup(middleware)
+
+    # Last pre_process, nothing cancels update after key is acquired
+    middleware = OrderedMiddleware(context.ordered)
+    context.dispatcher.middleware.setup(middleware)
+
+    if context.startup.enabled:
+        middleware = StartupMiddleware(context.startup)
+        context.dispatcher.middleware.setup(middleware)
+
 
 #######
 #
@@ -625,11 +2993,17 @@ def setup_middlewares(context):
 
 
 def safe_method(method):
+    method = timed(BOT_SECONDS)(method)
+
     async def wrapped(bot, *args, **kwargs):
         try:
             return await method(bot, *args, **kwargs)
         except exceptions.TelegramAPIError as error:
-            log(f'source=Bot.{method.__name__}, error={error!r}')
+            log(
+                'error',
+                source=f'Bot.{method.__name__}',
+                error=repr(error)
+            )
 
     return wrapped
 
@@ -640,34 +3014,584 @@ Bot.safe_delete_message = safe_method(Bot.delete_message)
 Bot.safe_forward_message = safe_method(Bot.forward_message)
 
 
+######
+#   SCHEDULER
+#####
+
+
+# Telegram allows ~30 requests/s per bot, ~20 messages/min per group
+# and ~1 message/s per private chat, over that answers 429
+# RetryAfter. Group and channel ids are negative. Every Bot API request goes
+# through BotScheduler: global token bucket, per chat bucket for
+# messages sent to the chat. RetryAfter pauses the bucket and requeues
+# the request. Ban and delete are not messages, raid replies do not
+# hold them in chat bucket, and they go before admin notifications
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+
+
+BOT_GLOBAL_RATE = 30
+BOT_GLOBAL_BURST = 30
+BOT_CHAT_RATE = 20 / 60
+BOT_PRIVATE_CHAT_RATE = 1
+BOT_CHAT_BURST = 20
+BOT_RETRY_ATTEMPTS = 3
+
+PRIORITY_ENFORCE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_NOTIFY = 2
+
+ENFORCE_METHODS = {
+    'banChatMember',
+    'deleteMessage',
+}
+
+# Count in per chat bucket
+CHAT_MESSAGE_METHODS = {
+    'sendMessage',
+    'sendPoll',
+    'forwardMessage',
+    'copyMessage',
+}
+
+
+def request_chat_id(method, data):
+    if method in CHAT_MESSAGE_METHODS:
+        return data and data.get('chat_id')
+
+
+def request_priority(method, data):
+    chat_id = data and data.get('chat_id')
+    if chat_id == CHAT_ID and method in ENFORCE_METHODS:
+        return PRIORITY_ENFORCE
+    elif chat_id == ADMIN_ID:
+        return PRIORITY_NOTIFY
+    return PRIORITY_DEFAULT
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.paused_until = 0
+
+    def delay(self, now):
+        self.tokens = min(
+            self.burst,
+            self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+        if now < self.paused_until:
+            return self.paused_until - now
+        elif self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, now, timeout):
+        self.paused_until = max(self.paused_until, now + timeout)
+
+
+@dataclass
+class BotRequest:
+    priority: int
+    seq: int
+    chat_id: object
+    call: object
+    future: asyncio.Future
+    attempt: int = 0
+    not_before: float = 0
+
+    @property
+    def order(self):
+        return self.priority, self.seq
+
+
+def fail_request(request):
+    # Same as failed API call, safe_* methods log it
+    if not request.future.done():
+        request.future.set_exception(
+            exceptions.TelegramAPIError('Bot scheduler closed')
+        )
+
+
+class BotScheduler:
+    def __init__(
+            self,
+            global_rate=BOT_GLOBAL_RATE,
+            global_burst=BOT_GLOBAL_BURST,
+            chat_rate=BOT_CHAT_RATE,
+            private_chat_rate=BOT_PRIVATE_CHAT_RATE,
+            chat_burst=BOT_CHAT_BURST,
+            retry_attempts=BOT_RETRY_ATTEMPTS
+    ):
+        self.chat_rate = chat_rate
+        self.private_chat_rate = private_chat_rate
+        self.chat_burst = chat_burst
+        self.retry_attempts = retry_attempts
+
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_buckets = {}
+
+        self.queue = []
+        self.seq = count()
+        self.wakeup = None
+        self.worker = None
+        self.tasks = set()
+        self.closed = False
+
+        self.inflight = 0
+        self.throttled = 0
+        self.delayed = 0
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if not bucket:
+            rate = (
+                self.private_chat_rate if chat_id > 0
+                else self.chat_rate
+            )
+            bucket = TokenBucket(rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def request_delay(self, request, now):
+        delay = max(
+            request.not_before - now,
+            self.global_bucket.delay(now)
+        )
+        if request.chat_id is not None:
+            delay = max(delay, self.chat_bucket(request.chat_id).delay(now))
+        return delay
+
+    def push(self, request):
+        if self.closed:
+            fail_request(request)
+            return
+
+        self.queue.append(request)
+        if not self.wakeup:
+            self.wakeup = asyncio.Event()
+        self.wakeup.set()
+        if not self.worker:
+            self.worker = asyncio.create_task(self.work())
+
+    async def submit(self, method, data, call):
+        request = BotRequest(
+            priority=request_priority(method, data),
+            seq=next(self.seq),
+            chat_id=request_chat_id(method, data),
+            call=call,
+            future=asyncio.get_running_loop().create_future()
+        )
+        self.push(request)
+        return await request.future
+
+    def next_request(self):
+        # Queue is short, linear scan. Paused chat does not block others
+        now = monotonic()
+        request, min_delay = None, None
+        for item in self.queue:
+            delay = self.request_delay(item, now)
+            if delay <= 0:
+                if not request or item.order < request.order:
+                    request = item
+            elif min_delay is None or delay < min_delay:
+                min_delay = delay
+        return request, min_delay
+
+    async def work(self):
+        while True:
+            self.wakeup.clear()
+            request, delay = self.next_request()
+            if request:
+                self.queue.remove(request)
+                self.global_bucket.take()
+                if request.chat_id is not None:
+                    self.chat_bucket(request.chat_id).take()
+
+                task = asyncio.create_task(self.run(request))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+                continue
+
+            if delay is not None:
+                self.delayed += 1
+            else:
+                self.evict_buckets()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self, request):
+        future = request.future
+        self.inflight += 1
+        try:
+            result = await request.call()
+        except exceptions.RetryAfter as error:
+            self.throttled += 1
+            now = monotonic()
+            if request.chat_id is not None:
+                self.chat_bucket(request.chat_id).pause(now, error.timeout)
+            else:
+                self.global_bucket.pause(now, error.timeout)
+
+            if request.attempt < self.retry_attempts:
+                request.attempt += 1
+                request.not_before = now + error.timeout
+                self.push(request)
+            elif not future.done():
+                future.set_exception(error)
+        except Exception as error:
+            if not future.done():
+                future.set_exception(error)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self.inflight -= 1
+
+    def evict_buckets(self):
+        # Queue is empty. Full and not paused bucket is same as new one
+        now = monotonic()
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if bucket.delay(now) == 0 and bucket.tokens >= bucket.burst:
+                del self.chat_buckets[chat_id]
+
+    async def close(self):
+        self.closed = True
+        if self.worker:
+            self.worker.cancel()
+            self.worker = None
+
+        for request in self.queue:
+            fail_request(request)
+        self.queue = []
+
+        # Retry of in-flight request fails in push
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+
+    def stats(self):
+        return {
+            'queued': len(self.queue),
+            'inflight': self.inflight,
+            'throttled': self.throttled,
+            'delayed': self.delayed,
+            'chat_buckets': len(self.chat_buckets),
+        }
+
+
+bot_request = Bot.request
+
+
+async def scheduled_request(bot, method, data=None, files=None, **kwargs):
+    call = partial(bot_request, bot, method, data, files, **kwargs)
+    if not bot.scheduler:
+        return await call()
+    return await bot.scheduler.submit(method, data, call)
+
+
+Bot.scheduler = None
+Bot.request = scheduled_request
+
+
+######
+#   PLAN
+#####
+
+
+# Ban is several independent Bot API calls, run them concurrently.
+# Action waits only for actions listed in after, forward must see the
+# message before delete. Error of any action is raised once all are
+# done, so failing admin notification does not cancel the ban
+
+
+@dataclass
+class Action:
+    name: str
+    call: object
+    after: [str] = ()
+
+
+async def run_plan(actions):
+    tasks = {}
+
+    async def run(action):
+        if action.after:
+            await asyncio.wait([tasks[_] for _ in action.after])
+        return await action.call()
+
+    for action in actions:
+        tasks[action.name] = asyncio.ensure_future(run(action))
+
+    results = await asyncio.gather(
+        *tasks.values(),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+
+def ban_plan(bot, chat_id, user_id, message_id, admin_text):
+    return [
+        Action('ban', partial(
+            bot.safe_ban_chat_member,
+            chat_id=chat_id,
+            user_id=user_id
+        )),
+        Action('notify', partial(
+            bot.send_message,
+            chat_id=ADMIN_ID,
+            text=admin_text
+        )),
+        Action('forward', partial(
+            bot.safe_forward_message,
+            chat_id=ADMIN_ID,
+            from_chat_id=chat_id,
+            message_id=message_id
+        )),
+        Action('delete', partial(
+            bot.safe_delete_message,
+            chat_id=chat_id,
+            message_id=message_id
+        ), after=['forward']),
+    ]
+
+
+########
+#   STARTUP
+######
+
+
+# Serverless container starts on first webhook request, Telegram
+# waits for import, init and on_startup. With STARTUP_PROFILE=1 phase
+# timings are logged once first update is handled. For import
+# breakdown python -X importtime main.py
+
+
+def process_uptime():
+    # Seconds since process start, includes interpreter start. Linux
+    # only, clock tick resolution
+    try:
+        with open('/proc/self/stat') as file:
+            stat = file.read()
+        with open('/proc/uptime') as file:
+            uptime = float(file.read().split()[0])
+    except OSError:
+        return
+
+    # Field 22 starttime, after "pid (comm)"
+    start = int(stat.rsplit(')', 1)[1].split()[19])
+    return uptime - start / sysconf('SC_CLK_TCK')
+
+
+class StartupProfile:
+    def __init__(self, enabled=STARTUP_PROFILE):
+        self.enabled = enabled
+        self.reported = False
+
+        # Process start -> profile init, mostly imports
+        self.phases = {'import': process_uptime()}
+        self.last = perf_counter()
+
+    def mark(self, name):
+        # Since previous mark
+        now = perf_counter()
+        self.phases[name] = now - self.last
+        self.last = now
+
+    async def measure(self, name, coroutine):
+        # Overlaps with marks, for concurrent phases
+        start = perf_counter()
+        try:
+            return await coroutine
+        finally:
+            self.phases[name] = perf_counter() - start
+
+    def first_update(self):
+        if self.enabled and not self.reported:
+            self.mark('first_update')
+            self.report()
+
+    def report(self):
+        if not self.enabled or self.reported:
+            return
+
+        self.reported = True
+        phases = dict(self.phases, total=process_uptime())
+        log('startup', **{
+            name: round(duration, 4)
+            for name, duration in phases.items()
+            if duration is not None
+        })
+
+
+class StartupMiddleware(BaseMiddleware):
+    def __init__(self, startup):
+        BaseMiddleware.__init__(self)
+        self.startup = startup
+
+    async def on_post_process_update(self, update, results, data):
+        self.startup.first_update()
+
+
 ########
 #   WEBHOOK
 ######
 
 
 async def on_startup(context, _):
-    await context.db.connect()
-    await context.moder.connect()
+    context.startup.mark('run')
+    start_log_listener()
+
+    # Independent clients, connect at once
+    await asyncio.gather(
+        context.startup.measure('db_connect', context.db.connect()),
+        context.startup.measure('moder_connect', context.moder.connect()),
+    )
+    await context.pipeline.start()
+    await context.jobs.start()
+    context.startup.mark('on_startup')
 
 
 async def on_shutdown(context, _):
+    # Finish moderation jobs while DB, moder are open
+    await context.pipeline.drain()
+    await context.jobs.close()
+    if context.bot.scheduler:
+        await context.bot.scheduler.close()
+
+    # Close flushes buffered user_stats
     await context.db.close()
     await context.moder.close()
 
+    session = await context.bot.get_session()
+    await session.close()
+
+    stop_log_listener()
+
+
+def metrics_authorized(request, token):
+    header = request.headers.get('Authorization', '')
+    return bool(token) and compare_digest(
+        header.encode(),
+        f'Bearer {token}'.encode()
+    )
+
+
+async def handle_metrics(context, request):
+    if not metrics_authorized(request, context.metrics_token):
+        raise web.HTTPUnauthorized()
+
+    return web.Response(
+        text=render_metrics(context),
+        content_type='text/plain',
+        headers={'X-Content-Type-Options': 'nosniff'}
+    )
+
 
 PORT = getenv('PORT', 8080)
 
+# Most webhook updates are dropped by handlers anyway: other chats,
+# edits, joins and pins. Building aiogram Update and running
+# dispatcher for them costs more than the useful ones. Read routing
+# fields from raw JSON, answer 200 to irrelevant at once. orjson if
+# installed, ~3x faster than json on update bodies
+
+loads_json = orjson.loads if orjson else json.loads
+
+WEBHOOK_UPDATE_TYPES = {
+    'message',
+    'poll_answer',
+    'my_chat_member',
+    'chat_member',
+}
+SERVICE_MESSAGE_FIELDS = {
+    'new_chat_members',
+    'left_chat_member',
+    'new_chat_title',
+    'new_chat_photo',
+    'delete_chat_photo',
+    'group_chat_created',
+    'supergroup_chat_created',
+    'migrate_to_chat_id',
+    'migrate_from_chat_id',
+    'pinned_message',
+    'message_auto_delete_timer_changed',
+    'video_chat_scheduled',
+    'video_chat_started',
+    'video_chat_ended',
+    'video_chat_participants_invited',
+}
+
+
+def update_drop_reason(data):
+    # my_chat_member from other chats passes, handler leaves the chat
+    if 'message' in data:
+        message = data['message']
+        if message['chat']['id'] != CHAT_ID:
+            return 'chat'
+        if 'from' not in message or SERVICE_MESSAGE_FIELDS & message.keys():
+            return 'service'
+    elif 'edited_message' in data:
+        return 'edit'
+    elif not WEBHOOK_UPDATE_TYPES & data.keys():
+        return 'type'
+
+
+STARTUP_KEY = 'bandugan_startup'
+
+
+class WebhookFilter(WebhookRequestHandler):
+    async def post(self):
+        self.validate_ip()
+        data = loads_json(await self.request.read())
+
+        reason = update_drop_reason(data)
+        if reason:
+            DROPPED.inc(reason)
+            # Cold start served by drop is still first update
+            startup = self.request.app.get(STARTUP_KEY)
+            if startup:
+                startup.first_update()
+            return web.Response(text='ok')
+
+        self.data = data
+        return await WebhookRequestHandler.post(self)
+
+    async def parse_update(self, bot):
+        return Update(**self.data)
+
+
+def webhook_app(context):
+    # Same app serves webhook and metrics. Not executor.start_webhook,
+    # it calls getMe before serving, extra Bot API round trip on every
+    # cold start
+    app = web.Application()
+    app[BOT_DISPATCHER_KEY] = context.dispatcher
+    app[STARTUP_KEY] = context.startup
+    app.router.add_route('*', '/', WebhookFilter)
+    if context.metrics_token:
+        app.router.add_get('/metrics', context.handle_metrics)
+
+    app.on_startup.append(context.on_startup)
+    app.on_shutdown.append(context.on_shutdown)
+    return app
 
-def run(context):
-    executor.start_webhook(
-        dispatcher=context.dispatcher,
 
-        webhook_path='/',
+def run(context):
+    web.run_app(
+        context.webhook_app(),
         port=PORT,
 
-        on_startup=context.on_startup,
-        on_shutdown=context.on_shutdown,
-
         # Disable aiohttp "Running on ... Press CTRL+C"
         # Polutes YC Logging
         print=None
@@ -681,24 +3605,37 @@ def run(context):
 
 class BotContext:
     def __init__(self):
+        self.startup = StartupProfile()
+
         self.bot = Bot(token=BOT_TOKEN)
+        self.bot.scheduler = BotScheduler()
         self.dispatcher = Dispatcher(self.bot)
-        self.db = DB()
+        self.db = DB(SqliteStore() if SQLITE_PATH else DynamoStore())
         self.moder = Moder()
+        self.pipeline = Pipeline()
+        self.jobs = Jobs(self)
+        self.chat_admins = ChatAdmins(self.bot)
+        self.ordered = OrderedExecutor()
+        self.metrics_token = METRICS_TOKEN
 
-    async def sleep(self, delay):
-        await asyncio.sleep(delay)
+        self.startup.mark('init')
 
 
+BotContext.handle_chat_member = handle_chat_member
 BotContext.handle_my_chat_member = handle_my_chat_member
+BotContext.moderate_message = moderate_message
 BotContext.handle_message = handle_message
 BotContext.handle_poll_answer = handle_poll_answer
+BotContext.delete_messages_job = delete_messages_job
+BotContext.close_voting_job = close_voting_job
 
 BotContext.setup_handlers = setup_handlers
 BotContext.setup_middlewares = setup_middlewares
 
 BotContext.on_startup = on_startup
 BotContext.on_shutdown = on_shutdown
+BotContext.handle_metrics = handle_metrics
+BotContext.webhook_app = webhook_app
 BotContext.run = run
 
 
@@ -713,4 +3650,5 @@ if __name__ == '__main__':
     context = BotContext()
     context.setup_handlers()
     context.setup_middlewares()
+    context.startup.mark('setup')
     context.run()
@@ -1,12 +1,22 @@
 
 import asyncio
+import logging
+from time import time
 from json import (
     loads as parse_json,
     dumps as format_json
 )
-from dataclasses import replace
+from dataclasses import (
+    dataclass,
+    replace
+)
+from typing import Optional
+from functools import partial
 
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from botocore.exceptions import ClientError
 
 from aiogram.types import (
     Update,
@@ -14,19 +24,54 @@ from aiogram.types import (
     Poll,
     Chat,
     ChatMember,
+    User,
 )
 
+from train import train_local_model
 from main import (
     Bot,
     Dispatcher,
     ChatMemberStatus,
 
     DB,
+    SqliteStore,
+    dynamo_ser_obj,
+    dynamo_deser_item,
     Moder, ModerPred,
+    Pipeline,
+    Jobs,
+    ChatAdmins,
+    OrderedExecutor,
+    WebhookFilter,
+    BOT_DISPATCHER_KEY,
+    STARTUP_KEY,
+    DROPPED,
+    StartupProfile,
     BotContext,
+    load_local_model,
+    save_local_model,
 
     Voting,
     UserStats,
+    BAN_VOTE,
+    NO_BAN_VOTE,
+    Action,
+    run_plan,
+    BotScheduler,
+    exceptions,
+    BANS,
+    HANDLER_SECONDS,
+    DYNAMO_SECONDS,
+    ERRORS,
+    CONDITIONAL_FAILED,
+    timed,
+    JSONFormatter,
+    LOG_MAX_LENGTH,
+    logger,
+    log,
+    LOG_SAMPLE_RATES,
+    log_listener_started,
+    stop_log_listener,
 
     CHAT_ID,
     ADMIN_ID,
@@ -74,6 +119,39 @@ async def test_db_votings(db):
     assert await db.get_voting(voting.poll_id) is None
 
 
+async def test_db_record_vote(db):
+    voting = Voting(
+        poll_id='-1',
+        chat_id=-1,
+
+        candidate_message_id=-1,
+        start_message_id=-1,
+        poll_message_id=-1,
+
+        candidate_user_id=-1,
+        starter_user_id=-1,
+
+        ban_user_ids=[],
+        no_ban_user_ids=[],
+        min_votes=1
+    )
+    await db.put_voting(voting)
+
+    voting = await db.record_vote(voting.poll_id, -1, BAN_VOTE)
+    assert voting.ban_user_ids == [-1]
+
+    await asyncio.gather(
+        db.record_vote(voting.poll_id, -1, NO_BAN_VOTE),
+        db.record_vote(voting.poll_id, -2, BAN_VOTE),
+    )
+    voting = await db.record_vote(voting.poll_id, -3, None)
+    assert voting.ban_user_ids == [-2]
+    assert voting.no_ban_user_ids == [-1]
+
+    await db.delete_voting(voting.poll_id)
+    assert await db.record_vote(voting.poll_id, -1, BAN_VOTE) is None
+
+
 async def test_db_user_stats(db):
     user_stats = UserStats(
         chat_id=-1,
@@ -88,6 +166,266 @@ async def test_db_user_stats(db):
     assert await db.get_user_stats(user_stats.key) is None
 
 
+async def test_db_increment_user_stats(db):
+    key = (-1, -1)
+    await db.delete_user_stats(key)
+
+    assert await db.atomic_increment_user_stats(key) == 1
+    assert await asyncio.gather(
+        db.atomic_increment_user_stats(key),
+        db.atomic_increment_user_stats(key),
+    ) in ([2, 3], [3, 2])
+    assert await db.get_user_stats(key) == UserStats(
+        chat_id=-1,
+        user_id=-1,
+        message_count=3
+    )
+
+    await db.delete_user_stats(key)
+
+
+class FakeDynamoClient:
+    def __init__(self):
+        self.tables = {}
+        self.calls = []
+
+    def table_items(self, table):
+        return self.tables.setdefault(table, {})
+
+    @staticmethod
+    def item_key(item):
+        # Every table has single S hash key
+        for name in ['poll_id', 'key']:
+            if name in item:
+                return item[name]['S']
+
+    async def put_item(self, TableName, Item):
+        self.calls.append('put_item')
+        self.table_items(TableName)[self.item_key(Item)] = Item
+
+    async def get_item(self, TableName, Key):
+        self.calls.append('get_item')
+        item = self.table_items(TableName).get(self.item_key(Key))
+        return {'Item': item} if item else {}
+
+    async def delete_item(self, TableName, Key):
+        self.calls.append('delete_item')
+        self.table_items(TableName).pop(self.item_key(Key), None)
+
+    async def update_item(
+            self, TableName, Key, UpdateExpression,
+            ExpressionAttributeValues, ReturnValues
+    ):
+        # Only user_stats counter, SET chat_id, user_id ADD message_count
+        self.calls.append('update_item')
+        await asyncio.sleep(0)
+        item = self.table_items(TableName).setdefault(
+            self.item_key(Key), dict(Key)
+        )
+        values = ExpressionAttributeValues
+        count = int(item.get('message_count', {'N': '0'})['N'])
+        count += int(values[':delta']['N'])
+        item.update(
+            chat_id=values[':chat_id'],
+            user_id=values[':user_id'],
+            message_count={'N': str(count)}
+        )
+        return {'Attributes': {'message_count': item['message_count']}}
+
+
+@pytest.fixture(scope='function')
+def fake_db():
+    db = DB(write_behind=True, user_stats_flush_size=2)
+    db.store.client = FakeDynamoClient()
+    return db
+
+
+async def test_write_behind_user_stats(fake_db):
+    for _ in range(3):
+        await fake_db.increment_user_stats((-1, -1))
+    assert fake_db.store.client.calls == ['get_item']
+    assert await fake_db.get_user_stats((-1, -1)) == UserStats(-1, -1, 3)
+
+    await fake_db.increment_user_stats((-1, -2))
+    assert fake_db.store.client.calls == [
+        'get_item', 'get_item', 'update_item', 'update_item'
+    ]
+    assert fake_db.user_stats_buffer == {}
+
+    assert await fake_db.increment_user_stats((-1, -1)) == 4
+    await fake_db.flush_user_stats()
+    assert await fake_db.store.get_user_stats((-1, -1)) == UserStats(-1, -1, 4)
+    assert await fake_db.store.get_user_stats((-1, -2)) == UserStats(-1, -2, 1)
+
+
+async def test_write_behind_deltas(fake_db):
+    # Other instance, same table
+    other = DB(write_behind=True)
+    other.store.client = fake_db.store.client
+
+    key = (-1, -1)
+    for db in [fake_db, other]:
+        for _ in range(3):
+            await db.increment_user_stats(key)
+    for db in [fake_db, other]:
+        await db.flush_user_stats()
+    assert await fake_db.store.get_user_stats(key) == UserStats(-1, -1, 6)
+    assert await other.get_user_stats(key) == UserStats(-1, -1, 6)
+
+    # Delete waits for running flush, not overwritten by its ADD
+    await fake_db.increment_user_stats(key)
+    flush = asyncio.create_task(fake_db.flush_user_stats())
+    await asyncio.sleep(0)
+    await fake_db.delete_user_stats(key)
+    await flush
+    assert not await fake_db.store.get_user_stats(key)
+
+
+async def test_trusted_user_stats(fake_db):
+    key = (-1, -1)
+    for _ in range(12):
+        message_count = await fake_db.increment_user_stats(key)
+    assert message_count == 10
+    assert fake_db.store.client.calls == ['get_item']
+    assert fake_db.user_stats_cache.stats() == {
+        'size': 1,
+        'hits': 11,
+        'misses': 2,
+    }
+
+
+async def test_active_votings(fake_db):
+    voting = replace(INIT_VOTING, ban_user_ids=[-1])
+    await fake_db.put_voting(voting)
+    assert await fake_db.get_voting(voting.poll_id) == voting
+    assert fake_db.store.client.calls == ['put_item']
+
+    fake_db.active_votings.pop(voting.poll_id)
+    assert await fake_db.get_voting(voting.poll_id) == voting
+    assert fake_db.store.client.calls == ['put_item', 'get_item']
+
+    await fake_db.put_voting(replace(voting, closed=True))
+    assert not await fake_db.record_vote(voting.poll_id, -2, BAN_VOTE)
+    assert fake_db.store.client.calls == ['put_item', 'get_item', 'put_item']
+
+
+async def test_sqlite_db(tmp_path):
+    path = str(tmp_path / 'bandugan.db')
+    db = DB(SqliteStore(path), write_behind=True, user_stats_flush_size=2)
+    await db.connect()
+
+    await db.put_voting(INIT_VOTING)
+    voting = await db.record_vote(INIT_VOTING.poll_id, -1, BAN_VOTE)
+    assert voting.ban_user_ids == [-1]
+    voting = await db.record_vote(INIT_VOTING.poll_id, -1, NO_BAN_VOTE)
+    assert voting.ban_user_ids == [] and voting.no_ban_user_ids == [-1]
+    assert await db.close_voting(INIT_VOTING.poll_id)
+    assert not await db.close_voting(INIT_VOTING.poll_id)
+    assert not await db.record_vote(INIT_VOTING.poll_id, -2, BAN_VOTE)
+    assert not await db.record_vote('-2', -2, BAN_VOTE)
+
+    for _ in range(3):
+        await db.increment_user_stats((-1, -1))
+    assert await db.atomic_increment_user_stats((-1, -2)) == 1
+    await db.close()
+
+    db = DB(SqliteStore(path))
+    await db.connect()
+    voting = await db.get_voting(INIT_VOTING.poll_id)
+    assert voting.closed and voting.no_ban_user_ids == [-1]
+    assert await db.get_user_stats((-1, -1)) == UserStats(-1, -1, 3)
+
+    assert await db.claim_update(1)
+    assert not await db.claim_update(1)
+    await db.release_update(1)
+    assert await db.claim_update(1)
+
+    await db.delete_user_stats((-1, -1))
+    await db.delete_voting(INIT_VOTING.poll_id)
+    assert not await db.get_user_stats((-1, -1))
+    assert not await db.get_voting(INIT_VOTING.poll_id)
+    await db.close()
+
+
+async def test_sqlite_flush_batch(tmp_path):
+    store = SqliteStore(str(tmp_path / 'bandugan.db'))
+    db = DB(store, write_behind=True, user_stats_flush_size=10)
+    await db.connect()
+    await db.put_user_stats(UserStats(-1, -1, 5))
+
+    calls = []
+    run = store.run
+
+    async def traced_run(function, *args):
+        calls.append(function.__name__)
+        return await run(function, *args)
+
+    store.run = traced_run
+    for user_id in [-1, -2, -3, -1]:
+        await db.increment_user_stats((-1, user_id))
+    calls.clear()
+    await db.flush_user_stats()
+
+    # One executor job, one transaction for all keys
+    assert calls == ['sql_add_user_stats_batch']
+    assert await db.get_user_stats((-1, -1)) == UserStats(-1, -1, 7)
+    assert await db.get_user_stats((-1, -3)) == UserStats(-1, -3, 1)
+    await db.close()
+
+
+async def test_jobs_persist(tmp_path, context):
+    context.db = DB(SqliteStore(str(tmp_path / 'bandugan.db')))
+    await context.db.connect()
+
+    jobs = Jobs(context, persist=True)
+    await jobs.schedule(60, 'delete_messages', chat_id=-1, message_ids=[1])
+    await jobs.close()
+    assert jobs.stats()['pending'] == 1
+    assert not context.bot.trace
+
+    # New container, job loaded from DB
+    context.jobs = Jobs(context, persist=True)
+    await context.jobs.start()
+    await context.jobs.flush()
+    assert match_trace(context.bot.trace, [
+        ['deleteMessage', '{"chat_id": -1, "message_id": 1}'],
+    ])
+    assert not await context.db.get_jobs()
+    await context.db.close()
+
+
+@dataclass
+class CodecObj:
+    id: str
+    score: float
+    is_bot: bool
+    tags: [str]
+    user_ids: [int]
+    parent_id: Optional[int]
+    count: int = 0
+
+
+def test_dynamo_codec():
+    obj = CodecObj(
+        id='1', score=0.5, is_bot=True,
+        tags=['a'], user_ids=[],
+        parent_id=None
+    )
+    item = dynamo_ser_obj(obj)
+    assert item == {
+        'id': {'S': '1'},
+        'score': {'N': '0.5'},
+        'is_bot': {'BOOL': True},
+        'tags': {'SS': ['a']},
+        'count': {'N': '0'},
+    }
+    assert dynamo_deser_item(item, CodecObj) == obj
+
+    del item['count']
+    item['parent_id'] = {'N': '2'}
+    assert dynamo_deser_item(item, CodecObj) == replace(obj, parent_id=2)
+
+
 ######
 #
 #   MODER
@@ -136,15 +474,19 @@ class FakeBot(Bot):
 
     safe_send_message = send_message
 
-    async def get_chat_member(self, **kwargs):
-        await self.request('getChatMember', kwargs)
+    async def get_chat_administrators(self, **kwargs):
+        await self.request('getChatAdministrators', kwargs)
 
-        status = (
-            ChatMemberStatus.ADMINISTRATOR
-            if self.admin_chat_member
-            else ChatMemberStatus.MEMBER
-        )
-        return ChatMember(status=status)
+        members = [ChatMember(
+            user=User(id=-3),
+            status=ChatMemberStatus.CREATOR
+        )]
+        if self.admin_chat_member:
+            members.append(ChatMember(
+                user=User(id=-1),
+                status=ChatMemberStatus.ADMINISTRATOR
+            ))
+        return members
 
     async def send_poll(self, **kwargs):
         await self.request('sendPoll', kwargs)
@@ -177,6 +519,35 @@ class FakeDB(DB):
             if _.poll_id != poll_id
         ]
 
+    async def record_vote(self, poll_id, user_id, option):
+        voting = await self.get_voting(poll_id)
+        if not voting or voting.closed:
+            return
+
+        ban_user_ids, no_ban_user_ids = [
+            [_ for _ in user_ids if _ != user_id]
+            for user_ids in [voting.ban_user_ids, voting.no_ban_user_ids]
+        ]
+        if option == BAN_VOTE:
+            ban_user_ids.append(user_id)
+        elif option == NO_BAN_VOTE:
+            no_ban_user_ids.append(user_id)
+
+        voting = replace(
+            voting,
+            ban_user_ids=ban_user_ids,
+            no_ban_user_ids=no_ban_user_ids
+        )
+        await self.put_voting(voting)
+        return voting
+
+    async def close_voting(self, poll_id):
+        voting = await self.get_voting(poll_id)
+        if not voting or voting.closed:
+            return False
+        await self.put_voting(replace(voting, closed=True))
+        return True
+
     async def put_user_stats(self, obj):
         await self.delete_user_stats(obj.key)
         self.user_stats.append(obj)
@@ -192,15 +563,28 @@ class FakeDB(DB):
             if _.key != key
         ]
 
+    async def increment_user_stats(self, key):
+        obj = await self.get_user_stats(key)
+        if not obj:
+            chat_id, user_id = key
+            obj = UserStats(chat_id, user_id, message_count=0)
+            self.user_stats.append(obj)
+        obj.message_count += 1
+        return obj.message_count
+
 
 class FakeModer(Moder):
     def __init__(self):
+        Moder.__init__(self)
+        self.texts = []
         self.pred = ModerPred(
             is_spam=False,
             confidence=1.0
         )
 
     async def predict(self, text):
+        self.texts.append(text)
+        await asyncio.sleep(0)
         return self.pred
 
 
@@ -210,9 +594,12 @@ class FakeBotContext(BotContext):
         self.dispatcher = Dispatcher(self.bot)
         self.db = FakeDB()
         self.moder = FakeModer()
-
-    async def sleep(self, delay):
-        pass
+        self.pipeline = Pipeline(enabled=False)
+        self.startup = StartupProfile(enabled=False)
+        self.jobs = Jobs(self, persist=False)
+        self.chat_admins = ChatAdmins(self.bot)
+        self.ordered = OrderedExecutor()
+        self.metrics_token = 'token'
 
 
 @pytest.fixture(scope='function')
@@ -227,6 +614,99 @@ def context():
     return context
 
 
+async def test_run_plan():
+    trace = []
+
+    async def call(name, delay):
+        await asyncio.sleep(delay)
+        trace.append(name)
+
+    async def fail():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        await run_plan([
+            Action('a', partial(call, 'a', 0.02)),
+            Action('b', partial(call, 'b', 0)),
+            Action('c', partial(call, 'c', 0), after=['a']),
+            Action('d', fail),
+        ])
+    assert trace == ['b', 'a', 'c']
+
+
+async def test_bot_scheduler():
+    scheduler = BotScheduler(global_burst=1, global_rate=1000)
+    trace = []
+
+    async def call(name, retry_after=None):
+        trace.append(name)
+        if retry_after:
+            retry_after.pop()
+            raise exceptions.RetryAfter(0.01)
+        return name
+
+    results = await asyncio.gather(
+        scheduler.submit('sendMessage', {'chat_id': ADMIN_ID}, partial(call, 'notify')),
+        scheduler.submit('sendMessage', {'chat_id': CHAT_ID}, partial(call, 'reply', [1])),
+        scheduler.submit('banChatMember', {'chat_id': CHAT_ID}, partial(call, 'ban')),
+    )
+    assert results == ['notify', 'reply', 'ban']
+    assert trace == ['ban', 'reply', 'notify', 'reply']
+    assert scheduler.stats()['throttled'] == 1
+    await scheduler.close()
+
+
+async def test_bot_scheduler_chat_buckets():
+    scheduler = BotScheduler(chat_burst=1, chat_rate=1000)
+
+    async def call(name):
+        return name
+
+    # Bucket of -1 refills, evicted when scheduler is idle
+    await scheduler.submit('sendMessage', {'chat_id': -1}, partial(call, 'a'))
+    await asyncio.sleep(0.01)
+    await scheduler.submit('sendMessage', {'chat_id': -2}, partial(call, 'b'))
+    assert list(scheduler.chat_buckets) == [-2]
+    await scheduler.close()
+
+    # Raid replies spent chat bucket, ban does not wait for it
+    scheduler = BotScheduler(chat_burst=1, chat_rate=0.001)
+    submit = scheduler.submit
+    await submit('sendMessage', {'chat_id': CHAT_ID}, partial(call, 'reply'))
+    reply = asyncio.create_task(
+        submit('sendMessage', {'chat_id': CHAT_ID}, partial(call, 'reply'))
+    )
+    assert await asyncio.wait_for(
+        submit('banChatMember', {'chat_id': CHAT_ID}, partial(call, 'ban')),
+        timeout=1
+    ) == 'ban'
+
+    # Queued reply fails on close, not left pending
+    assert scheduler.stats()['queued'] == 1
+    await scheduler.close()
+    with pytest.raises(exceptions.TelegramAPIError):
+        await reply
+
+
+def test_bot_scheduler_chat_rate():
+    scheduler = BotScheduler()
+    assert scheduler.chat_bucket(1).rate == 1
+
+    # Send as soon as bucket allows for 10 minutes, after initial burst
+    # group gets at most 20 messages per minute
+    bucket = scheduler.chat_bucket(CHAT_ID)
+    bucket.updated = 0
+    now, sent = 0, 0
+    while now < 600:
+        delay = bucket.delay(now)
+        if delay:
+            now += delay
+        else:
+            bucket.take()
+            sent += 1
+    assert sent - bucket.burst <= 20 * 10
+
+
 async def process_update(context, json):
     data = parse_json(json)
     update = Update(**data)
@@ -251,6 +731,10 @@ def my_chat_member_json(chat_id):
     return '{"my_chat_member": {"chat": {"id": %d, "title": "C", "type": "group", "all_members_are_administrators": true}, "from": {"id": -1, "is_bot": false, "first_name": "A", "last_name": "K", "username": "ak", "language_code": "ru"}, "date": 1711016747, "old_chat_member": {"user": {"id": -1, "is_bot": true, "first_name": "C", "username": "c"}, "status": "left"}, "new_chat_member": {"user": {"id": -3, "is_bot": true, "first_name": "C", "username": "c"}, "status": "member"}}}' % chat_id
 
 
+def chat_member_json(chat_id, old='member', new='administrator'):
+    return '{"chat_member": {"chat": {"id": %d, "title": "C", "type": "supergroup"}, "from": {"id": -3, "is_bot": false, "first_name": "A"}, "date": 1711016747, "old_chat_member": {"user": {"id": -1, "is_bot": false, "first_name": "A"}, "status": "%s"}, "new_chat_member": {"user": {"id": -1, "is_bot": false, "first_name": "A"}, "status": "%s"}}}' % (chat_id, old, new)
+
+
 def message_json(chat_id, text):
     return '{"message": {"message_id": -1, "from": {"id": -1, "is_bot": false, "first_name": "A", "last_name": "K", "username": "ak"}, "chat": {"id": %d, "title": "C", "username": "c", "type": "supergroup"}, "date": 1711091220, "text": "%s"}}' % (chat_id, text)
 
@@ -263,6 +747,213 @@ def poll_answer_json(option_id):
     return '{"poll_answer": {"poll_id": "-1", "user": {"id": -1, "is_bot": false, "first_name": "A", "last_name": "K", "username": "ak", "language_code": "ru"}, "option_ids": [%d]}}' % option_id
 
 
+async def test_pool_stats(aiohttp_server):
+    async def handle(request):
+        return web.Response(text='ok')
+
+    app = web.Application()
+    app.router.add_get('/', handle)
+    server = await aiohttp_server(app)
+
+    moder = Moder()
+    await moder.connect()
+    for _ in range(3):
+        async with moder.session.get(server.make_url('/')) as response:
+            await response.read()
+
+    # Keep-alive, single connection reused
+    stats = moder.pool_stats()
+    assert stats['requests'] == 3
+    assert stats['connections'] == 1
+    await moder.close()
+
+
+async def test_webhook_filter(context, aiohttp_client):
+    app = web.Application()
+    app[BOT_DISPATCHER_KEY] = context.dispatcher
+    app.router.add_post('/', WebhookFilter)
+    client = await aiohttp_client(app)
+
+    edited = message_json(CHAT_ID, 'привет').replace('message', 'edited_message', 1)
+    bodies = [
+        message_json(-1, '/voteban'),
+        edited,
+        '{"update_id": 1, "callback_query": {}}',
+        message_json(CHAT_ID, '/voteban'),
+        my_chat_member_json(-1),
+    ]
+    before = DROPPED.series.copy()
+    for body in bodies:
+        response = await client.post('/', data=body)
+        assert response.status == 200
+
+    # Only /voteban in chat and my_chat_member reached dispatcher
+    assert [method for method, _ in context.bot.trace] == [
+        'sendMessage', 'leaveChat'
+    ]
+    for reason in ['chat', 'edit', 'type']:
+        assert DROPPED.series[reason] == before.get(reason, 0) + 1
+
+
+async def test_webhook_filter_startup(context, aiohttp_client, caplog):
+    # bench.py startup posts from other chat, dropped by filter
+    context.startup = StartupProfile(enabled=True)
+    app = web.Application()
+    app[BOT_DISPATCHER_KEY] = context.dispatcher
+    app[STARTUP_KEY] = context.startup
+    app.router.add_post('/', WebhookFilter)
+    client = await aiohttp_client(app)
+
+    logger.addHandler(caplog.handler)
+    try:
+        response = await client.post('/', data=message_json(-1, 'start'))
+    finally:
+        logger.removeHandler(caplog.handler)
+
+    assert response.status == 200
+    assert not context.bot.trace
+    [record] = [
+        _.msg for _ in caplog.records
+        if _.msg['event'] == 'startup'
+    ]
+    assert 'first_update' in record
+
+
+async def test_ordered_executor():
+    executor = OrderedExecutor(queue_size=3)
+    trace = []
+
+    async def run(key, index, delay):
+        future = await executor.acquire(key)
+        trace.append(('start', key, index))
+        await asyncio.sleep(delay)
+        trace.append(('end', key, index))
+        executor.release(key, future)
+
+    # Long key queue is not dropped. Over 3 admitted b waits for slot
+    await asyncio.gather(
+        run('a', 1, 0.02),
+        run('a', 2, 0),
+        run('a', 3, 0),
+        run('b', 1, 0),
+    )
+    assert trace == [
+        ('start', 'a', 1),
+        ('end', 'a', 1),
+        ('start', 'a', 2),
+        ('start', 'b', 1),
+        ('end', 'a', 2),
+        ('end', 'b', 1),
+        ('start', 'a', 3),
+        ('end', 'a', 3),
+    ]
+    assert executor.stats() == {'keys': 0, 'admitted': 0, 'waiting': 0}
+
+
+async def test_pred_cache():
+    moder = FakeModer()
+    texts = [
+        'Зарабатывай на крипте',
+        '  ЗАРАБАТЫВАЙ\u200b на   крипте ',
+        'Зaрaбaтывaй нa kриптe',  # Latin a, k, e
+    ]
+    await asyncio.gather(*(
+        moder.safe_predict(_)
+        for _ in texts
+    ))
+    await moder.safe_predict(texts[0])
+    await moder.safe_predict('Другой текст')
+    assert moder.texts == [texts[0], 'Другой текст']
+    assert moder.pred_cache.stats() == {
+        'size': 2,
+        'hits': 1,
+        'misses': 4,
+    }
+
+
+async def test_pred_batching():
+    moder = FakeModer()
+    moder.batching = True
+    moder.batch_size = 3
+    moder.max_inflight = 2
+
+    active = []
+    predict = moder.predict
+
+    async def tracked_predict(text):
+        active.append(text)
+        assert len(active) <= 2
+        pred = await predict(text)
+        active.remove(text)
+        return pred
+
+    moder.predict = tracked_predict
+
+    texts = [str(_) for _ in range(5)]
+    tasks = [
+        asyncio.create_task(moder.safe_predict(_))
+        for _ in texts
+    ]
+    for _ in range(2):
+        await asyncio.sleep(0)
+    assert moder.batch_stats() == {'queued': 2, 'inflight': 3}
+
+    preds = await asyncio.gather(*tasks)
+    assert preds == [moder.pred] * 5
+    assert sorted(moder.texts) == texts
+    assert moder.batch_stats() == {'queued': 0, 'inflight': 0}
+
+
+SPAM_TEXTS = [
+    'зарабатывай на крипте от 1000$ в день, пиши в лс',
+    'ищу людей на удаленку, доход от 500$ в неделю, пиши в лс',
+    'крипта, арбитраж, доход каждый день, подробности в лс',
+    'набираю команду, заработок на крипте, пиши в личку',
+]
+HAM_TEXTS = [
+    'какой токенизатор лучше для русского языка?',
+    'попробуй natasha, там есть сегментация и морфология',
+    'у меня bert падает по памяти на длинных текстах',
+    'спасибо, помогло, модель заработала',
+]
+
+
+async def test_local_moder(tmp_path):
+    model = train_local_model(
+        SPAM_TEXTS * 5 + HAM_TEXTS * 5,
+        [1] * 20 + [0] * 20,
+        dim=2 ** 12, holdout=0
+    )
+    path = tmp_path / 'moder.npz'
+    save_local_model(model, path)
+
+    moder = FakeModer()
+    moder.local_model = load_local_model(path)
+    assert moder.local_model.ngram_sizes == model.ngram_sizes
+
+    pred = await moder.safe_predict(SPAM_TEXTS[0])
+    assert pred.is_spam
+    pred = await moder.safe_predict(HAM_TEXTS[0])
+    assert not pred.is_spam
+    assert moder.texts == []
+
+
+async def test_local_moder_no_ngrams():
+    # Sticker, photo without caption: padded text is 2 chars
+    model = train_local_model(
+        SPAM_TEXTS * 5 + HAM_TEXTS * 5 + [''],
+        [1] * 20 + [0] * 20 + [0],
+        dim=2 ** 12, ngram_sizes=[3, 4, 5], holdout=0
+    )
+    moder = FakeModer()
+    moder.local_model = model
+    assert moder.local_predict(None) is None
+
+    # Falls back to remote
+    await moder.safe_predict(None)
+    assert moder.texts == [None]
+
+
 async def test_bot_leave_chat(context):
     await process_update(context, my_chat_member_json(CHAT_ID))
     await process_update(context, my_chat_member_json(-1))
@@ -280,18 +971,44 @@ async def test_bot_pass(context):
 
 
 async def test_bot_user_stats(context):
+    await process_update(context, message_json(CHAT_ID, '...'))
     await process_update(context, message_json(CHAT_ID, '...'))
     assert context.db.user_stats == [
-        UserStats(chat_id=CHAT_ID, user_id=-1, message_count=1)
+        UserStats(chat_id=CHAT_ID, user_id=-1, message_count=2)
     ]
 
 
+async def test_bot_dedup(context):
+    data = parse_json(message_json(CHAT_ID, '...'))
+    data['update_id'] = 1
+    update = Update(**data)
+    for _ in range(2):
+        await context.dispatcher.process_updates([update])
+    assert context.db.user_stats[0].message_count == 1
+
+    # Failed update is retried on redelivery
+    increment_user_stats = context.db.increment_user_stats
+    context.db.increment_user_stats = None
+    update.update_id = 2
+    with pytest.raises(TypeError):
+        await context.dispatcher.process_updates([update])
+
+    context.db.increment_user_stats = increment_user_stats
+    await context.dispatcher.process_updates([update])
+    assert context.db.user_stats[0].message_count == 2
+
+
 async def test_bot_use_reply(context):
     await process_update(context, message_json(CHAT_ID, '/voteban'))
+    assert context.jobs.stats()['pending'] == 1
+    assert len(context.bot.trace) == 1
+
+    await context.jobs.flush()
+    assert context.jobs.stats()['done'] == 1
     assert match_trace(context.bot.trace, [
         ['sendMessage', '{"chat_id": %d, "text": "Напиши это в реплае на спам' % CHAT_ID],
         ['deleteMessage', '{"chat_id": %d, "message_id": -1}' % CHAT_ID],
-        ['deleteMessage', '{"chat_id": -1, "message_id": -1}']
+        ['deleteMessage', '{"chat_id": %d, "message_id": -1}' % CHAT_ID]
     ])
     
 
@@ -306,13 +1023,165 @@ async def test_bot_moder_delete(context):
     ])
 
 
+async def test_bot_moder_flood(context):
+    # Burst from single user over queue bound and TRUSTED_MESSAGE_COUNT,
+    # every message moderated
+    context.ordered.queue_size = 4
+    context.moder.pred.is_spam = True
+    predict = context.moder.predict
+
+    async def slow_predict(text):
+        await asyncio.sleep(0.01)
+        return await predict(text)
+
+    context.moder.predict = slow_predict
+
+    updates = []
+    for index in range(1, 13):
+        data = parse_json(message_json(CHAT_ID, 'крипто скам'))
+        data['update_id'] = index
+        data['message']['message_id'] = index
+        updates.append(Update(**data))
+    await context.dispatcher.process_updates(updates)
+
+    deleted = [
+        parse_json(data)['message_id']
+        for method, data in context.bot.trace
+        if method == 'deleteMessage'
+    ]
+    assert sorted(deleted) == list(range(1, 13))
+    assert context.ordered.stats()['admitted'] == 0
+
+
+def test_log_format():
+    formatter = JSONFormatter()
+    text = 'спам ' * LOG_MAX_LENGTH
+
+    record = logging.makeLogRecord({
+        'msg': {'event': 'update', 'text': text, 'chat_id': -1}
+    })
+    data = parse_json(formatter.format(record))
+    assert data['chat_id'] == -1
+    assert len(data['text']) == LOG_MAX_LENGTH + 3
+    assert data['text_hash']
+
+    record = logging.makeLogRecord({
+        'msg': {'event': 'ban_decision', 'text': text}
+    })
+    data = parse_json(formatter.format(record))
+    assert data['text'] == text
+
+
+async def test_on_startup(context):
+    trace = []
+
+    async def connect(name):
+        trace.append(('start', name))
+        await asyncio.sleep(0)
+        trace.append(('done', name))
+
+    context.db.connect = partial(connect, 'db')
+    context.moder.connect = partial(connect, 'moder')
+    await context.on_startup(None)
+    assert log_listener_started()
+    stop_log_listener()
+    assert not log_listener_started()
+
+    # Connected concurrently
+    assert trace[:2] == [('start', 'db'), ('start', 'moder')]
+    assert sorted(context.startup.phases) == [
+        'db_connect', 'import', 'moder_connect', 'on_startup', 'run'
+    ]
+
+
+def test_log_sampled(caplog, monkeypatch):
+    monkeypatch.setitem(LOG_SAMPLE_RATES, 'startup', 0)
+    monkeypatch.setitem(LOG_SAMPLE_RATES, 'error', 0)
+    logger.addHandler(caplog.handler)
+    try:
+        log('startup', total=1)
+        log('error', source='test')
+        log('other')
+    finally:
+        logger.removeHandler(caplog.handler)
+
+    # Error is never sampled
+    events = [_.msg['event'] for _ in caplog.records]
+    assert events == ['error', 'other']
+
+
+async def test_bot_metrics(context):
+    bans = BANS.series.get('moder', 0)
+    context.moder.pred.is_spam = True
+    await process_update(context, message_json(CHAT_ID, 'крипто скамерский скам'))
+    assert BANS.series['moder'] == bans + 1
+
+    _, duration = HANDLER_SECONDS.series['handle_message']
+    assert duration > 0
+
+    for headers in [{}, {'Authorization': 'Bearer other'}]:
+        request = make_mocked_request('GET', '/metrics', headers=headers)
+        with pytest.raises(web.HTTPUnauthorized):
+            await context.handle_metrics(request)
+
+    request = make_mocked_request(
+        'GET', '/metrics',
+        headers={'Authorization': 'Bearer token'}
+    )
+    response = await context.handle_metrics(request)
+    lines = response.text.splitlines()
+    assert 'bandugan_bans_total{source="moder"} %d' % (bans + 1) in lines
+    assert 'bandugan_cache_size{cache="user_stats"} 0' in lines
+    assert any(
+        _.startswith('bandugan_bot_seconds_count{method="ban_chat_member"}')
+        for _ in lines
+    )
+
+
+async def test_timed_conditional_failed():
+    @timed(DYNAMO_SECONDS, 'test_op')
+    async def op(code):
+        raise ClientError({'Error': {'Code': code}}, 'UpdateItem')
+
+    errors = ERRORS.series.get('test_op', 0)
+    for code in ['ConditionalCheckFailedException', 'InternalServerError']:
+        with pytest.raises(ClientError):
+            await op(code)
+
+    # Closed poll, duplicate claim are not errors
+    assert CONDITIONAL_FAILED.series['test_op'] == 1
+    assert ERRORS.series['test_op'] == errors + 1
+
+
+async def test_bot_pipeline(context):
+    context.pipeline = Pipeline(enabled=True)
+    await context.pipeline.start()
+
+    context.moder.pred.is_spam = True
+    await process_update(context, message_json(CHAT_ID, 'крипто скамерский скам'))
+    assert context.bot.trace == []
+
+    await context.pipeline.drain()
+    assert [method for method, _ in context.bot.trace] == [
+        'banChatMember', 'sendMessage', 'forwardMessage', 'deleteMessage'
+    ]
+    stages = context.pipeline.stats()['stages']
+    assert sorted(stages) == ['enforce', 'predict', 'queue']
+
+
 async def test_bot_start_voting(context):
     await process_update(context, reply_message_json('/voteban'))
     assert match_trace(context.bot.trace, [
-        ['getChatMember', '{"chat_id": %d, "user_id": -1}' % CHAT_ID],
+        ['getChatAdministrators', '{"chat_id": %d}' % CHAT_ID],
         ['sendPoll',  '{"chat_id": %d, "question": "Забанить' % CHAT_ID],
     ])
-    assert context.db.votings == [
+
+    voting, = context.db.votings
+    assert time() < voting.deadline < voting.expires_at
+    job, = context.jobs.heap
+    assert job.name == 'close_voting'
+    assert job.kwargs == {'poll_id': voting.poll_id}
+    assert [replace(voting, deadline=0, expires_at=0)] == [
         Voting(
             poll_id='-1',
             chat_id=-1,
@@ -331,11 +1200,36 @@ async def test_bot_start_voting(context):
 async def test_bot_ban_admin(context):
     context.bot.admin_chat_member = True
     await process_update(context, reply_message_json('/voteban'))
+    await context.jobs.flush()
     assert match_trace(context.bot.trace, [
-        ['getChatMember', '{"chat_id": %d, "user_id": -1}' % CHAT_ID],
+        ['getChatAdministrators', '{"chat_id": %d}' % CHAT_ID],
         ['sendMessage', '{"chat_id": %d, "text": "A K админ"' % CHAT_ID],
         ['deleteMessage', '{"chat_id": %d, "message_id": -1}' % CHAT_ID],
-        ['deleteMessage', '{"chat_id": -1, "message_id": -1}'],
+        ['deleteMessage', '{"chat_id": %d, "message_id": -1}' % CHAT_ID],
+    ])
+
+
+async def test_bot_chat_admins_cache(context):
+    await process_update(context, reply_message_json('/voteban'))
+    context.bot.admin_chat_member = True
+    await process_update(context, reply_message_json('/voteban'))
+    assert [method for method, _ in context.bot.trace] == [
+        'getChatAdministrators', 'sendPoll', 'sendPoll'
+    ]
+
+    # Plain member joins, admin set is the same
+    await process_update(context, chat_member_json(CHAT_ID, 'left', 'member'))
+    context.bot.trace.clear()
+    await process_update(context, reply_message_json('/voteban'))
+    assert [method for method, _ in context.bot.trace] == ['sendPoll']
+
+    # Candidate promoted, next /voteban sees new admin set
+    await process_update(context, chat_member_json(CHAT_ID))
+    context.bot.trace.clear()
+    await process_update(context, reply_message_json('/voteban'))
+    assert match_trace(context.bot.trace, [
+        ['getChatAdministrators', '{"chat_id": %d}' % CHAT_ID],
+        ['sendMessage', '{"chat_id": %d, "text": "A K админ"' % CHAT_ID],
     ])
 
 
@@ -355,12 +1249,29 @@ async def test_bot_ban_vote(context):
         ['banChatMember', '{"chat_id": -1, "user_id": -2'],
         ['sendMessage', '{"chat_id": %d, "text": "voting ban"}' % ADMIN_ID],
         ['forwardMessage', '{"chat_id": %d, "from_chat_id": -1, "message_id": 2}' % ADMIN_ID],
-        ['deleteMessage', '{"chat_id": -1, "message_id": 2}'],
         ['deleteMessage', '{"chat_id": -1, "message_id": 3}'],
-        ['deleteMessage', '{"chat_id": -1, "message_id": 1}']
+        ['deleteMessage', '{"chat_id": -1, "message_id": 1}'],
+        ['deleteMessage', '{"chat_id": -1, "message_id": 2}'],
     ])
     voting = await context.db.get_voting(INIT_VOTING.poll_id)
     assert voting.ban_user_ids == [-1]
+    assert voting.closed
+
+
+async def test_bot_ban_decision_log(context, caplog):
+    logger.addHandler(caplog.handler)
+    try:
+        context.db.votings = [INIT_VOTING]
+        await process_update(context, poll_answer_json(0))
+    finally:
+        logger.removeHandler(caplog.handler)
+
+    [record] = [
+        _.msg for _ in caplog.records
+        if _.msg['event'] == 'ban_decision'
+    ]
+    assert record['decision'] == BAN_VOTE
+    assert record['ban_user_ids'] == [-1]
 
 
 async def test_bot_no_ban_vote(context):
@@ -374,6 +1285,52 @@ async def test_bot_no_ban_vote(context):
     assert voting.no_ban_user_ids == [-1]
 
 
+async def test_bot_closed_vote(context):
+    context.db.votings = [replace(INIT_VOTING, closed=True)]
+    await process_update(context, poll_answer_json(0))
+    assert context.bot.trace == []
+    voting = await context.db.get_voting(INIT_VOTING.poll_id)
+    assert voting.ban_user_ids == []
+
+
+async def test_bot_stale_vote(context):
+    context.db.votings = [replace(INIT_VOTING, deadline=int(time()) - 1)]
+    await process_update(context, poll_answer_json(0))
+    assert match_trace(context.bot.trace, [
+        ['deleteMessage', '{"chat_id": -1, "message_id": 3}'],
+        ['deleteMessage', '{"chat_id": -1, "message_id": 1}']
+    ])
+    voting = await context.db.get_voting(INIT_VOTING.poll_id)
+    assert voting.closed
+
+
+async def test_bot_unknown_poll(context):
+    await process_update(context, poll_answer_json(0))
+    assert context.bot.trace == []
+
+
+async def test_bot_close_voting_job(context):
+    context.db.votings = [INIT_VOTING]
+    await context.jobs.schedule(0, 'close_voting', poll_id=INIT_VOTING.poll_id)
+    await context.jobs.schedule(60, 'close_voting', poll_id='-2')
+    await context.jobs.schedule(60, 'delete_messages', chat_id=-1, message_ids=[4])
+    await asyncio.sleep(0.01)
+    assert match_trace(context.bot.trace, [
+        ['deleteMessage', '{"chat_id": -1, "message_id": 3}'],
+        ['deleteMessage', '{"chat_id": -1, "message_id": 1}']
+    ])
+    voting = await context.db.get_voting(INIT_VOTING.poll_id)
+    assert voting.closed
+
+    # Closed voting is not closed twice, on shutdown only cleanup runs
+    await context.close_voting_job(INIT_VOTING.poll_id)
+    await context.jobs.close()
+    assert context.jobs.stats() == {
+        'pending': 0, 'running': 0, 'done': 2, 'failed': 0
+    }
+    assert len(context.bot.trace) == 3
+
+
 async def test_bot_revote(context):
     context.db.votings = [
         replace(INIT_VOTING, min_votes=2)
@@ -0,0 +1,164 @@
+import sys
+import json
+import argparse
+
+import numpy as np
+
+from main import (
+    LocalModel,
+    text_ngram_ids,
+    local_model_score,
+    save_local_model,
+)
+
+
+# Train local spam pre-classifier for Moder, see LOCAL in main.py.
+# Corpus is JSONL, one {"text": "...", "is_spam": true} per line
+
+# python train.py corpus.jsonl moder.npz
+# MODER_MODEL_PATH=moder.npz python main.py
+
+
+DIM = 2 ** 18
+NGRAM_SIZES = [1, 2, 3, 4]
+EPOCHS = 5
+LEARNING_RATE = 0.5
+HOLDOUT = 0.2
+
+# Share of wrong local decisions allowed on holdout, per class
+MAX_ERROR = 0.01
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def load_corpus(path):
+    texts, labels = [], []
+    with open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            texts.append(record['text'])
+            labels.append(int(record['is_spam']))
+    return texts, np.array(labels)
+
+
+def sigmoid(z):
+    return 1 / (1 + np.exp(-z))
+
+
+def fit_weights(
+        samples, labels, dim,
+        epochs=EPOCHS, learning_rate=LEARNING_RATE, seed=0
+):
+    # Logistic regression, SGD over sparse hashed features
+    weights = np.zeros(dim, dtype=np.float32)
+    bias = 0.0
+
+    random = np.random.default_rng(seed)
+    for _ in range(epochs):
+        for index in random.permutation(len(samples)):
+            ids = samples[index]
+            scale = 1 / np.sqrt(len(ids))
+            z = weights[ids].sum() * scale + bias
+            gradient = sigmoid(z) - labels[index]
+            np.add.at(weights, ids, -learning_rate * gradient * scale)
+            bias -= learning_rate * gradient
+
+    return weights, float(bias)
+
+
+def min_threshold(scores, labels, max_error):
+    # Smallest t, share of ham among scores >= t stays <= max_error
+    order = np.argsort(-scores)
+    errors = np.cumsum(labels[order] == 0)
+    counts = np.arange(1, len(scores) + 1)
+    ok = np.flatnonzero(errors <= max_error * counts)
+    if len(ok):
+        return float(scores[order][ok[-1]])
+    return 1.0
+
+
+def fit_thresholds(scores, labels, max_error=MAX_ERROR):
+    spam_threshold = min_threshold(scores, labels, max_error)
+    ham_threshold = 1 - min_threshold(1 - scores, 1 - labels, max_error)
+    return (
+        min(ham_threshold, 0.5),
+        max(spam_threshold, 0.5)
+    )
+
+
+def train_local_model(
+        texts, labels,
+        dim=DIM, ngram_sizes=NGRAM_SIZES,
+        epochs=EPOCHS, holdout=HOLDOUT, max_error=MAX_ERROR
+):
+    labels = np.asarray(labels)
+    samples = [
+        text_ngram_ids(_, ngram_sizes, dim)
+        for _ in texts
+    ]
+
+    # Texts shorter than all n-gram sizes have no features
+    keep = [index for index, _ in enumerate(samples) if len(_)]
+    samples = [samples[_] for _ in keep]
+    labels = labels[keep]
+
+    random = np.random.default_rng(0)
+    order = random.permutation(len(samples))
+    split = len(samples) - int(len(samples) * holdout)
+    train, test = order[:split], order[split:]
+    if not len(test):
+        test = train
+
+    weights, bias = fit_weights(
+        [samples[_] for _ in train], labels[train],
+        dim, epochs=epochs
+    )
+    model = LocalModel(
+        weights=weights,
+        bias=bias,
+        ngram_sizes=list(ngram_sizes),
+        ham_threshold=0.5,
+        spam_threshold=0.5
+    )
+
+    scores = np.array([
+        local_model_score(model, samples[_])
+        for _ in test
+    ])
+    model.ham_threshold, model.spam_threshold = fit_thresholds(
+        scores, labels[test], max_error
+    )
+    return model
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('corpus')
+    parser.add_argument('output')
+    parser.add_argument('--dim', type=int, default=DIM)
+    parser.add_argument('--epochs', type=int, default=EPOCHS)
+    parser.add_argument('--holdout', type=float, default=HOLDOUT)
+    parser.add_argument('--max-error', type=float, default=MAX_ERROR)
+    args = parser.parse_args(args)
+
+    texts, labels = load_corpus(args.corpus)
+    log(f'texts={len(texts)}, spam={labels.sum()}')
+
+    model = train_local_model(
+        texts, labels,
+        dim=args.dim,
+        epochs=args.epochs,
+        holdout=args.holdout,
+        max_error=args.max_error
+    )
+    log(
+        f'ham_threshold={model.ham_threshold:.3f}, '
+        f'spam_threshold={model.spam_threshold:.3f}'
+    )
+    save_local_model(model, args.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])